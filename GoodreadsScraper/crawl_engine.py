@@ -0,0 +1,87 @@
+"""Long lived, in-process crawl engine for the web app
+
+Starting a `scrapy crawl` subprocess per request means paying for interpreter startup, the Scrapy/Twisted imports and
+settings loading on every batch. Instead, a single Twisted reactor is run in a daemon thread for the lifetime of the
+process and crawls are scheduled on it through a CrawlerRunner. Scraped items are handed back to the calling thread
+directly, either all at once or one by one as the spider yields them. At most CRAWL_ENGINE_MAX_CRAWLS crawls run at
+once, further ones wait for a free slot.
+"""
+import logging
+import queue
+import threading
+
+from scrapy import signals
+from scrapy.crawler import CrawlerRunner
+from scrapy.utils.project import get_project_settings
+from twisted.internet import reactor
+from twisted.internet.threads import blockingCallFromThread
+from twisted.python.failure import Failure
+
+logger = logging.getLogger(__name__)
+
+_CRAWL_FINISHED = object()
+
+
+class CrawlEngine(object):
+    def __init__(self, settings=None):
+        self.settings = settings if settings is not None else get_project_settings()
+        self.runner = None
+        self.crawl_slots = threading.BoundedSemaphore(self.settings.getint("CRAWL_ENGINE_MAX_CRAWLS", 1))
+        self._reactor_thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the reactor thread, this is a no-op if it is already running"""
+        with self._start_lock:
+            if self._reactor_thread is not None:
+                return
+            self.runner = CrawlerRunner(self.settings)
+            # Signal handlers can only be installed from the main thread, which belongs to the web server
+            self._reactor_thread = threading.Thread(target=reactor.run, kwargs={"installSignalHandlers": False},
+                                                    name="crawl-engine-reactor", daemon=True)
+            self._reactor_thread.start()
+            logger.info("Started in-process crawl engine")
+
+    def crawl(self, spider_cls, **spider_kwargs):
+        """Run a spider to completion and return the scraped items as a list of dicts
+
+        This blocks the calling thread, so it must never be called from the reactor thread itself.
+        """
+        return list(self.iter_crawl(spider_cls, **spider_kwargs))
+
+    def iter_crawl(self, spider_cls, **spider_kwargs):
+        """Run a spider and yield each scraped item as a dict as soon as the spider produces it
+
+        The crawl only starts once a crawl slot is free.
+        """
+        self.start()
+        results = queue.Queue()
+        with self.crawl_slots:
+            crawler = blockingCallFromThread(reactor, self._start_crawl, spider_cls, results, spider_kwargs)
+            finished = False
+            try:
+                while True:
+                    result = results.get()
+                    if result is _CRAWL_FINISHED:
+                        finished = True
+                        return
+                    if isinstance(result, Failure):
+                        finished = True
+                        result.raiseException()
+                    yield result
+            finally:
+                if not finished:
+                    # Nobody is consuming the items anymore (e.g. the client hung up), so stop crawling for them
+                    reactor.callFromThread(crawler.stop)
+
+    def _start_crawl(self, spider_cls, results, spider_kwargs):
+        crawler = self.runner.create_crawler(spider_cls)
+
+        def item_scraped(item, response, spider):
+            results.put(dict(item))
+
+        # The dispatcher only keeps weak references by default, which would let the closure be garbage collected
+        crawler.signals.connect(item_scraped, signal=signals.item_scraped, weak=False)
+        crawl_deferred = self.runner.crawl(crawler, **spider_kwargs)
+        crawl_deferred.addCallbacks(lambda _: results.put(_CRAWL_FINISHED), results.put)
+        return crawler
@@ -0,0 +1,77 @@
+"""Normalization of the dates found on Goodreads pages to TIME_FORMAT strings
+
+Fuzzy dateutil parsing is slow, but nearly every date we scrape comes in one of a handful of fixed formats ("Sep 12, 2017"
+in review lists, "September 12, 2017" on author pages, "Dec 2011" or "2011" for partially known dates) and the same
+values repeat constantly. Those formats are recognised by precompiled patterns, anything else goes through dateutil
+exactly like before, and results are memoized either way. The output is identical to
+`dateutil.parser.parse(date, fuzzy=True, default=datetime.min).strftime(TIME_FORMAT)`, with None for unparseable dates.
+"""
+import datetime
+import re
+from functools import lru_cache
+
+from dateutil.parser import parse as dateutil_parse, parserinfo
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+DATE_CACHE_SIZE = 65536
+
+# Same month names, and abbreviations, as dateutil accepts
+MONTHS = {name.lower(): number for number, names in enumerate(parserinfo.MONTHS, start=1) for name in names}
+
+_DAY = r"(0?[1-9]|[12]\d|3[01])"
+_YEAR = r"([1-9]\d{3})"
+MONTH_DAY_YEAR = re.compile(r"([A-Za-z]+)\s+" + _DAY + r",?\s+" + _YEAR)
+MONTH_YEAR = re.compile(r"([A-Za-z]+)\s+" + _YEAR)
+YEAR = re.compile(_YEAR)
+TIMESTAMP = re.compile(r"(\d{4})-(\d{2})-(\d{2})(?:[ T](\d{2}):(\d{2}):(\d{2}))?")
+NOT_SET = {"", "not set"}
+
+
+def normalize_date(date):
+    """Return the date formatted as TIME_FORMAT, or None if it isn't a date"""
+    if not isinstance(date, str):
+        return None
+    return _normalize_date(date)
+
+
+def normalize_dates(dates):
+    """Normalize a batch of dates, e.g. a whole DataFrame column"""
+    return [normalize_date(date) for date in dates]
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _normalize_date(date):
+    stripped = date.strip()
+    if stripped.lower() in NOT_SET:
+        return None
+    try:
+        parsed = _match_known_format(stripped)
+        if parsed is None:
+            parsed = dateutil_parse(date, fuzzy=True, default=datetime.datetime.min)
+    except ValueError:
+        return None
+    return parsed.strftime(TIME_FORMAT)
+
+
+def _match_known_format(date):
+    """Parse the formats Goodreads uses without dateutil, None means the date is in some other format
+
+    Impossible dates like "Feb 30, 2017" raise ValueError, just like dateutil does for them.
+    """
+    match = MONTH_DAY_YEAR.fullmatch(date)
+    if match and match.group(1).lower() in MONTHS:
+        return datetime.datetime(int(match.group(3)), MONTHS[match.group(1).lower()], int(match.group(2)))
+
+    match = MONTH_YEAR.fullmatch(date)
+    if match and match.group(1).lower() in MONTHS:
+        return datetime.datetime(int(match.group(2)), MONTHS[match.group(1).lower()], 1)
+
+    match = YEAR.fullmatch(date)
+    if match:
+        return datetime.datetime(int(match.group(1)), 1, 1)
+
+    match = TIMESTAMP.fullmatch(date)
+    if match and match.group(1)[0] != "0":
+        return datetime.datetime(*(int(group) for group in match.groups(default="0")))
+
+    return None
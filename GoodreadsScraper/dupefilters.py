@@ -0,0 +1,118 @@
+"""Duplicate request filters which keep memory bounded on very large crawls"""
+import hashlib
+import logging
+import math
+import os
+import re
+import struct
+
+from scrapy.dupefilters import BaseDupeFilter
+from scrapy.utils.job import job_dir
+from scrapy.utils.request import referer_str, request_fingerprint
+
+logger = logging.getLogger(__name__)
+
+USER_ID_EXTRACTOR = re.compile(r"/user/show/(\d+)")
+BLOOM_HEADER = struct.Struct("<QQQ")
+
+
+class BloomFilter(object):
+    """Fixed size Bloom filter, sized for `capacity` keys at the given false positive rate"""
+
+    def __init__(self, capacity, error_rate, num_bits=None, num_hashes=None, count=0, bits=None):
+        self.num_bits = num_bits or max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = num_hashes or max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bits if bits is not None else bytearray((self.num_bits + 7) // 8)
+        self.count = count
+
+    def add(self, key):
+        """Add a key, returning True if it was (probably) already present"""
+        # Double hashing: two 64 bit halves of one digest stand in for num_hashes independent hash functions
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first_hash = int.from_bytes(digest[:8], "little")
+        second_hash = int.from_bytes(digest[8:], "little") | 1
+
+        present = True
+        for i in range(self.num_hashes):
+            position = (first_hash + i * second_hash) % self.num_bits
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not self.bits[byte] & mask:
+                present = False
+                self.bits[byte] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+    def dump(self, path):
+        # Write to a temporary file first so a crash mid-write never leaves a truncated filter behind
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as bloom_file:
+            bloom_file.write(BLOOM_HEADER.pack(self.num_bits, self.num_hashes, self.count))
+            bloom_file.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as bloom_file:
+            num_bits, num_hashes, count = BLOOM_HEADER.unpack(bloom_file.read(BLOOM_HEADER.size))
+            bits = bytearray(bloom_file.read())
+        return cls(None, None, num_bits=num_bits, num_hashes=num_hashes, count=count, bits=bits)
+
+
+class UserIdBloomDupeFilter(BaseDupeFilter):
+    """Filters requests for user profiles that were already seen, keyed on the numeric Goodreads user ID
+
+    Instead of a set of request fingerprints, which grows with every profile, seen user IDs are kept in a Bloom
+    filter of fixed size (USER_ID_BLOOM_CAPACITY keys at USER_ID_BLOOM_ERROR_RATE). A false positive just means a
+    profile is skipped. With a JOBDIR the filter is persisted there when the crawl is closed, and whenever the
+    DeferringScheduler checkpoints its queues. It is never saved on its own, a saved filter that is ahead of the saved
+    queues would mark requests as seen that a resumed crawl no longer has.
+    """
+
+    def __init__(self, path=None, capacity=10_000_000, error_rate=0.001, debug=False):
+        self.path = os.path.join(path, "user_ids.bloom") if path else None
+        self.debug = debug
+        self.logdupes = True
+        if self.path and os.path.exists(self.path):
+            self.bloom = BloomFilter.load(self.path)
+            logger.info(f"Resuming with {self.bloom.count} previously seen user IDs from {self.path}")
+        else:
+            self.bloom = BloomFilter(capacity, error_rate)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(job_dir(settings),
+                   capacity=settings.getint('USER_ID_BLOOM_CAPACITY', 10_000_000),
+                   error_rate=settings.getfloat('USER_ID_BLOOM_ERROR_RATE', 0.001),
+                   debug=settings.getbool('DUPEFILTER_DEBUG'))
+
+    def request_seen(self, request):
+        return self.bloom.add(self.request_key(request))
+
+    @staticmethod
+    def request_key(request):
+        user_id = USER_ID_EXTRACTOR.search(request.url)
+        if user_id:
+            return b"user:" + user_id.group(1).encode()
+        return request_fingerprint(request).encode()
+
+    def flush(self):
+        if self.path:
+            self.bloom.dump(self.path)
+
+    def close(self, reason):
+        self.flush()
+
+    def log(self, request, spider):
+        if self.debug:
+            msg = "Filtered duplicate request: %(request)s (referer: %(referer)s)"
+            args = {'request': request, 'referer': referer_str(request)}
+            logger.debug(msg, args, extra={'spider': spider})
+        elif self.logdupes:
+            msg = ("Filtered duplicate request: %(request)s"
+                   " - no more duplicates will be shown"
+                   " (see DUPEFILTER_DEBUG to show all duplicates)")
+            logger.debug(msg, {'request': request}, extra={'spider': spider})
+            self.logdupes = False
+
+        spider.crawler.stats.inc_value('dupefilter/filtered', spider=spider)
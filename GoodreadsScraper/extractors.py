@@ -0,0 +1,134 @@
+"""Compiled, single pass item extraction
+
+An ItemLoader evaluates every add_css/add_xpath call on its own: each one goes through a Selector, runs its query over
+the whole document and, for the same query used by several fields, runs it again for every one of them. The extractors
+here compile their queries once at import time, evaluate each distinct query (or regex scan) once per page, or walk the
+cells of a table row once, and then run exactly the input and output processors the loader would have run, so they
+produce the same items as the loaders they replace.
+"""
+from collections import OrderedDict
+
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
+from scrapy.utils.misc import arg_to_iter, extract_regex
+from scrapy.utils.python import flatten
+from w3lib.html import replace_entities
+
+_css_translator = HTMLTranslator()
+
+
+class Rule(object):
+    """Collect values for `field` the way one loader add_css/add_xpath/add_value call would
+
+    A rule without a query takes its value from the keyword arguments of `Extractor.load`. If `key` is given, `regex`
+    must have two groups and only the matches whose first group equals `key` are kept, which lets a single scan with
+    one regex fill several fields. `cell` restricts the rule to the `<td>` cells with that class, for `RowExtractor`.
+    """
+
+    def __init__(self, field, css=None, xpath=None, regex=None, key=None, cell=None):
+        self.field = field
+        self.query = _css_translator.css_to_xpath(css) if css else xpath
+        self.regex = regex
+        self.key = key
+        self.cell = cell
+
+
+class Extractor(object):
+    """Extracts one item per page, evaluating every distinct query of its rules only once"""
+
+    def __init__(self, item_cls, loader_cls, rules):
+        self.item_cls = item_cls
+        self.rules = rules
+        self.fields = list(OrderedDict.fromkeys(rule.field for rule in rules))
+        self.input_processors = {field: _get_processor(loader_cls, item_cls, field, "in") for field in self.fields}
+        self.output_processors = {field: _get_processor(loader_cls, item_cls, field, "out") for field in self.fields}
+        self.compiled_queries = {}
+        for rule in rules:
+            if rule.query is not None and self._query_key(rule) not in self.compiled_queries:
+                self.compiled_queries[self._query_key(rule)] = etree.XPath(rule.query, smart_strings=False)
+
+    def collect(self, node):
+        """Return the raw values of every rule, as {field: [values of each rule for that field]}"""
+        results = self._evaluate(node)
+        keyed_matches = {}
+        collected = OrderedDict((field, []) for field in self.fields)
+        for rule in self.rules:
+            if rule.query is None:
+                continue
+            values = results.get(self._query_key(rule), [])
+            if rule.key is not None:
+                scan = (self._query_key(rule), rule.regex)
+                if scan not in keyed_matches:
+                    keyed_matches[scan] = [(key, replace_entities(value, keep=['lt', 'amp']))
+                                           for text in values for key, value in rule.regex.findall(text)]
+                values = [value for key, value in keyed_matches[scan] if key == rule.key]
+            elif rule.regex is not None:
+                values = flatten(extract_regex(rule.regex, text) for text in values)
+            collected[rule.field].append(values)
+        return collected
+
+    def extract(self, node, **values):
+        return self.load(self.collect(node), **values)
+
+    def load(self, collected, **values):
+        """Build the item from collected values, `values` stand in for everything collected for their fields"""
+        item = self.item_cls()
+        for field, value_lists in collected.items():
+            if field in values:
+                value_lists = [] if values[field] is None else [values[field]]
+            processed_values = []
+            for value in value_lists:
+                processed = self.input_processors[field](arg_to_iter(value))
+                if processed:
+                    processed_values += arg_to_iter(processed)
+            if processed_values:
+                output = self.output_processors[field](processed_values)
+                if output is not None:
+                    item[field] = output
+        return item
+
+    @staticmethod
+    def first(collected, field):
+        """The first raw value collected for a field, like SelectorList.get()"""
+        return next((values[0] for values in collected[field] if values), None)
+
+    def _evaluate(self, node):
+        return {key: query(node) for key, query in self.compiled_queries.items()}
+
+    @staticmethod
+    def _query_key(rule):
+        return rule.query
+
+
+class RowExtractor(Extractor):
+    """Extracts one item per table row, visiting each `<td>` cell of the row once
+
+    Rule queries are relative to the cell, so `td[@class="field title"]//a/@href` becomes `.//a/@href` with
+    `cell="field title"`.
+    """
+
+    def __init__(self, item_cls, loader_cls, rules):
+        super().__init__(item_cls, loader_cls, rules)
+        self.queries_by_cell = {}
+        for key in self.compiled_queries:
+            self.queries_by_cell.setdefault(key[0], []).append(key)
+
+    def _evaluate(self, row):
+        results = {}
+        for cell in row.iterchildren("td"):
+            for key in self.queries_by_cell.get(cell.get("class"), ()):
+                results.setdefault(key, []).extend(self.compiled_queries[key](cell))
+        return results
+
+    @staticmethod
+    def _query_key(rule):
+        return rule.cell, rule.query
+
+
+def _get_processor(loader_cls, item_cls, field, kind):
+    """Resolve a field's input or output processor the way ItemLoader.get_input/output_processor does"""
+    processor = getattr(loader_cls, f"{field}_{kind}", None)
+    if not processor:
+        default = getattr(loader_cls, f"default_{kind}put_processor")
+        processor = item_cls.fields[field].get(f"{kind}put_processor", default)
+    return processor
@@ -0,0 +1,126 @@
+"""HTTP cache policy and storage for book and author pages
+
+Re-scrapes of the catalogue mostly hit pages that haven't changed since the last visit. Book and author pages are kept
+in a single zlib compressed SQLite key/value file, keyed by their canonical Goodreads ID so that
+/book/show/12232938-the-lovely-bones and /book/show/12232938.The_Lovely_Bones share an entry. A cached page is served
+as is while it is younger than the TTL of its page type, and revalidated with ETag/Last-Modified after that.
+
+Enable it with:
+
+    HTTPCACHE_ENABLED = True
+    HTTPCACHE_POLICY = 'GoodreadsScraper.httpcache.PageTypeCachePolicy'
+    HTTPCACHE_STORAGE = 'GoodreadsScraper.httpcache.CompressedKeyValueCacheStorage'
+    HTTPCACHE_PAGE_TTLS = {'book': 86400, 'author': 604800}
+"""
+import logging
+import os
+import pickle
+import re
+import sqlite3
+import zlib
+from time import time
+
+from scrapy.extensions.httpcache import RFC2616Policy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from scrapy.utils.request import request_fingerprint
+
+logger = logging.getLogger(__name__)
+
+PAGE_ID_EXTRACTORS = {
+    "book": re.compile(r"^https?://www\.goodreads\.com/book/show/(\d+)"),
+    "author": re.compile(r"^https?://www\.goodreads\.com/author/show/(\d+)"),
+}
+
+
+def page_cache_key(url):
+    """Return a (page type, canonical ID) tuple for cacheable Goodreads pages, or None for anything else"""
+    for page_type, extractor in PAGE_ID_EXTRACTORS.items():
+        match = extractor.match(url)
+        if match:
+            return page_type, match.group(1)
+    return None
+
+
+class PageTypeCachePolicy(RFC2616Policy):
+    """Caches book and author pages, serving them without revalidation for a configurable TTL per page type"""
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.page_ttls = settings.getdict('HTTPCACHE_PAGE_TTLS')
+
+    def should_cache_request(self, request):
+        cache_key = page_cache_key(request.url)
+        if cache_key is None or cache_key[0] not in self.page_ttls:
+            return False
+        return super().should_cache_request(request)
+
+    def should_cache_response(self, response, request):
+        # Only 200s: entries are keyed by book or author ID rather than URL, so a cached redirect (say from
+        # /book/show/5907.The_Hobbit to /book/show/5907-the-hobbit) would be served for its own target, forever.
+        # Goodreads rarely sends explicit expiration hints, the page type TTL takes their place
+        return response.status == 200 and b'no-store' not in self._parse_cachecontrol(response)
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        page_type, _ = page_cache_key(request.url)
+        current_age = self._compute_current_age(cachedresponse, request, time())
+        if current_age < self.page_ttls[page_type]:
+            return True
+        # Past the TTL, the RFC2616 policy sets If-None-Match/If-Modified-Since so unchanged pages come back as a 304
+        return super().is_cached_response_fresh(cachedresponse, request)
+
+
+class CompressedKeyValueCacheStorage(object):
+    """Stores responses as zlib compressed blobs in a single SQLite file instead of one directory per response"""
+
+    def __init__(self, settings):
+        cache_dir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.db_path = os.path.join(cache_dir, settings.get('HTTPCACHE_SQLITE_FILE', 'pages.sqlite3'))
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.compression_level = settings.getint('HTTPCACHE_COMPRESSION_LEVEL', 6)
+        self.db = None
+
+    def open_spider(self, spider):
+        # Several crawls may share the file when running in the web app, so wait for locks instead of failing
+        self.db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, stored_at REAL, data BLOB)")
+        logger.debug(f"Using compressed key/value cache storage in {self.db_path}", extra={'spider': spider})
+
+    def close_spider(self, spider):
+        self.db.close()
+
+    def retrieve_response(self, spider, request):
+        row = self.db.execute("SELECT stored_at, data FROM responses WHERE key = ?",
+                              (self._request_key(request),)).fetchone()
+        if row is None:
+            return  # not cached
+
+        stored_at, data = row
+        if 0 < self.expiration_secs < time() - stored_at:
+            return  # expired
+
+        data = pickle.loads(zlib.decompress(data))
+        headers = Headers(data['headers'])
+        # The entry may have been stored under another URL for the same book or author
+        respcls = responsetypes.from_args(headers=headers, url=request.url)
+        return respcls(url=request.url, headers=headers, status=data['status'], body=data['body'])
+
+    def store_response(self, spider, request, response):
+        data = {
+            'status': response.status,
+            'headers': dict(response.headers),
+            'body': response.body,
+        }
+        compressed = zlib.compress(pickle.dumps(data, protocol=2), self.compression_level)
+        self.db.execute("INSERT OR REPLACE INTO responses (key, stored_at, data) VALUES (?, ?, ?)",
+                        (self._request_key(request), time(), compressed))
+
+    @staticmethod
+    def _request_key(request):
+        cache_key = page_cache_key(request.url)
+        if cache_key is None:
+            return request_fingerprint(request)
+        return ":".join(cache_key)
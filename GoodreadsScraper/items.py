@@ -7,15 +7,18 @@ import datetime
 # http://doc.scrapy.org/en/latest/topics/items.html
 import json
 import re
+from abc import ABCMeta
+from collections.abc import MutableMapping
+from pprint import pformat
 
 import scrapy
-from dateutil.parser import parse as dateutil_parse
 from scrapy import Field
+from scrapy.item import BaseItem
 from scrapy.loader import ItemLoader
 from scrapy.loader.processors import Compose, MapCompose, TakeFirst, Join
 from w3lib.html import remove_tags
 
-TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+from .dates import TIME_FORMAT, normalize_date
 
 
 def num_page_extractor(num_pages):
@@ -25,13 +28,7 @@ def num_page_extractor(num_pages):
 
 
 def safe_parse_date(date):
-    try:
-        date = dateutil_parse(date, fuzzy=True, default=datetime.datetime.min)
-        date = date.strftime(TIME_FORMAT)
-    except ValueError:
-        date = None
-
-    return date
+    return normalize_date(date)
 
 
 def extract_legacy_publish_date(maybe_dates):
@@ -165,7 +162,95 @@ class BookItem(scrapy.Item):
     rating_histogram = Field(input_processor=extract_ratings_as_json)
 
 
-class UserProfileItem(scrapy.Item):
+class CompactItemMeta(ABCMeta):
+    """Turns the Field attributes of a CompactItem into slots, and collects their metadata in `fields` like ItemMeta"""
+
+    def __new__(mcs, class_name, bases, attrs):
+        own_fields = {name: value for name, value in attrs.items() if isinstance(value, Field)}
+        fields = {}
+        for base in reversed(bases):
+            fields.update(getattr(base, 'fields', {}))
+        fields.update(own_fields)
+
+        attrs = {name: value for name, value in attrs.items() if name not in own_fields}
+        attrs['__slots__'] = tuple(own_fields)
+        attrs['fields'] = fields
+        return super().__new__(mcs, class_name, bases, attrs)
+
+
+class CompactItem(BaseItem, MutableMapping, metaclass=CompactItemMeta):
+    """Item that keeps its field values in slots rather than in a values dict
+
+    It's declared and used just like a scrapy.Item, and pipelines and exporters can't tell the difference, but an
+    instance is a fraction of the size (see benchmarks/item_memory.py). Meant for the item types crawls create by the
+    million. Field names must not shadow Mapping methods like `get` or `keys`.
+
+    Instances aren't fully slotted: scrapy's BaseItem declares no __slots__, so they still have a __dict__. It stays
+    unallocated as long as nothing sets an attribute that isn't a field.
+
+    Compact items are not tracked by scrapy.utils.trackref: recording every live item in a WeakKeyDictionary costs
+    three times as much memory as the item itself.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __init__(self, *args, **kwargs):
+        if args or kwargs:
+            for key, value in dict(*args, **kwargs).items():
+                self[key] = value
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(f"{self.__class__.__name__} does not support field: {key}")
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self.fields and hasattr(self, key)
+
+    def __iter__(self):
+        return (name for name in self.fields if hasattr(self, name))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return pformat(dict(self))
+
+    # Hashed by identity like scrapy.Item, a mutable mapping's contents can change while it is a set member or dict key
+    def __hash__(self):
+        return id(self)
+
+    def copy(self):
+        return self.__class__(self)
+
+
+class CompactItemLoader(ItemLoader):
+    """ItemLoader that also finds the field processors of CompactItems, it only looks them up on scrapy.Items"""
+
+    def _get_item_field_attr(self, field_name, key, default=None):
+        if isinstance(self.item, CompactItem):
+            return self.item.fields[field_name].get(key, default)
+        return super()._get_item_field_attr(field_name, key, default)
+
+
+class UserProfileItem(CompactItem):
     profile_url = Field()
 
 
@@ -197,7 +282,7 @@ class AuthorLoader(ItemLoader):
     default_output_processor = TakeFirst()
 
 
-class UserReviewItem(scrapy.Item):
+class UserReviewItem(CompactItem):
     user_id = Field()
     user_id_slug = Field()
 
@@ -213,5 +298,5 @@ class UserReviewItem(scrapy.Item):
     user_rating = Field(serializer=int)
 
 
-class UserReviewLoader(ItemLoader):
+class UserReviewLoader(CompactItemLoader):
     default_output_processor = TakeFirst()
@@ -0,0 +1,107 @@
+"""Asynchronous crawl jobs for the web app
+
+Instead of holding the HTTP request open for the whole crawl, a job is queued and its ID handed back right away. Jobs
+run on a fixed number of worker threads, each of which blocks on a CrawlEngine crawl, so the number of concurrent
+crawls per node is a setting rather than something the hosting platform has to enforce. Finished jobs, and their
+results, are kept around for a while for clients to poll.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class JobQueueFull(Exception):
+    """Raised by JobManager.submit when there are too many jobs waiting to run already"""
+
+
+class Job(object):
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+
+    @property
+    def finished(self):
+        return self.status in (SUCCEEDED, FAILED)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+class JobManager(object):
+    """Runs jobs on `workers` threads, with at most `max_queued` of them waiting for a free worker"""
+
+    def __init__(self, workers=1, max_queued=100, retention_secs=3600):
+        self.max_queued = max_queued
+        self.retention_secs = retention_secs
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crawl-job")
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(workers=settings.getint("CRAWL_ENGINE_MAX_CRAWLS", 1),
+                   max_queued=settings.getint("CRAWL_JOBS_MAX_QUEUED", 100),
+                   retention_secs=settings.getfloat("CRAWL_JOBS_RETENTION_SECS", 3600))
+
+    def submit(self, kind, function, *args):
+        """Queue function(*args) as a job, whatever it returns becomes the job result"""
+        with self.lock:
+            self._expire()
+            if sum(1 for job in self.jobs.values() if job.status == QUEUED) >= self.max_queued:
+                raise JobQueueFull(f"{self.max_queued} jobs are queued already")
+            job = Job(kind)
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job, function, args)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            self._expire()
+            return self.jobs.get(job_id)
+
+    def _run(self, job, function, args):
+        with self.lock:
+            job.started_at = time.time()
+            job.status = RUNNING
+        try:
+            result, error, status = function(*args), None, SUCCEEDED
+        except Exception as e:
+            logger.exception(f"Job {job.id} ({job.kind}) failed")
+            result, error, status = None, str(e), FAILED
+        # Polls must never see a finished job without its result or finish time
+        with self.lock:
+            job.result = result
+            job.error = error
+            job.finished_at = time.time()
+            job.status = status
+
+    def _expire(self):
+        expire_before = time.time() - self.retention_secs
+        expired = [job.id for job in self.jobs.values()
+                   if job.finished and job.finished_at is not None and job.finished_at < expire_before]
+        for job_id in expired:
+            del self.jobs[job_id]
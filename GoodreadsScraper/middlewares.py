@@ -5,7 +5,44 @@
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
+import logging
+import re
+import time
+from email.utils import parsedate_to_datetime
+
 from scrapy import signals
+from scrapy.core.downloader import Slot
+from scrapy.downloadermiddlewares.robotstxt import RobotsTxtMiddleware
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+
+logger = logging.getLogger(__name__)
+
+# Request classes that get their own download slot and rate, by URL path
+ENDPOINT_PATTERNS = [
+    ("book", re.compile(r"^/book/show/")),
+    ("author", re.compile(r"^/author/show/")),
+    ("review_list", re.compile(r"^/review/list/")),
+    ("user_profile", re.compile(r"^/user/show/")),
+    ("sitemap", re.compile(r"^/(?:siteindex|sitemap)\.")),
+]
+THROTTLING_STATUS_CODES = {429, 503}
+
+# Sent by EndpointThrottleMiddleware with `endpoint` and `until` (a timestamp) when a Retry-After pauses an endpoint
+endpoint_paused = object()
+
+
+def request_endpoint(request, endpoints=None):
+    """The endpoint EndpointThrottleMiddleware paces a request as, or None for requests it leaves alone"""
+    endpoint = request.meta.get('throttle_endpoint')
+    # Leave requests alone that something else already picked a download slot for
+    if endpoint is not None or 'download_slot' in request.meta:
+        return endpoint
+    path = urlparse_cached(request).path
+    for name, pattern in ENDPOINT_PATTERNS:
+        if (endpoints is None or name in endpoints) and pattern.match(path):
+            return name
+    return None
 
 
 class GoodreadsscraperSpiderMiddleware(object):
@@ -54,3 +91,159 @@ class GoodreadsscraperSpiderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class SharedRobotsTxtMiddleware(RobotsTxtMiddleware):
+    """RobotsTxtMiddleware which shares parsed robots.txt files between crawlers in the same process
+
+    The web app runs many short crawls in one long lived process, and there is no point in fetching robots.txt again
+    for every single one of them. Parsed files are kept for ROBOTSTXT_SHARED_CACHE_SECS seconds.
+    """
+    _shared_parsers = {}
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        self.shared_cache_secs = crawler.settings.getint('ROBOTSTXT_SHARED_CACHE_SECS', 3600)
+
+    def robot_parser(self, request, spider):
+        netloc = urlparse_cached(request).netloc
+        if netloc not in self._parsers and netloc in self._shared_parsers:
+            parser, parsed_at = self._shared_parsers[netloc]
+            if time.time() - parsed_at < self.shared_cache_secs:
+                self._parsers[netloc] = parser
+                self.crawler.stats.inc_value('robotstxt/shared_cache_hit')
+        return super().robot_parser(request, spider)
+
+    def _parse_robots(self, response, netloc, spider):
+        super()._parse_robots(response, netloc, spider)
+        self._shared_parsers[netloc] = (self._parsers[netloc], time.time())
+
+
+class AimdRateController(object):
+    """Additive increase, multiplicative decrease controller for the request rate of one endpoint
+
+    Every response within the target latency raises the rate by a fixed step. Slower responses scale it down in
+    proportion to how far they missed the target, and throttling responses or download errors cut it by `decrease`.
+    """
+
+    def __init__(self, rate, min_rate, max_rate, increase, decrease, target_latency):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+
+    @property
+    def delay(self):
+        return 1.0 / self.rate
+
+    def on_response(self, latency):
+        if latency <= self.target_latency:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+        else:
+            self.rate = max(self.min_rate, self.rate * max(self.decrease, self.target_latency / latency))
+
+    def on_throttled(self):
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+
+
+class EndpointThrottleMiddleware(object):
+    """Paces book, author, review list, user profile and sitemap requests independently of each other
+
+    Each endpoint gets its own download slot, whose delay is driven by an AimdRateController. 429 and 503 responses
+    back the endpoint off, and a Retry-After header pauses its slot altogether for that long. Requests to anything else
+    keep the regular per domain slot and DOWNLOAD_DELAY. The current rates are kept in the throttle/<endpoint>/rate
+    stats.
+
+    Requests waiting in a download slot still count against CONCURRENT_REQUESTS, so the pause is also announced with
+    the endpoint_paused signal, for the DeferringScheduler to keep further requests of the endpoint out of the
+    downloader until it is over.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ENDPOINT_THROTTLE_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.slot_concurrency = settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')
+        self.randomize_delay = settings.getbool('RANDOMIZE_DOWNLOAD_DELAY')
+        self.max_retry_after = settings.getfloat('ENDPOINT_THROTTLE_MAX_RETRY_AFTER', 600)
+        min_rate = settings.getfloat('ENDPOINT_THROTTLE_MIN_RATE', 0.1)
+        self.controllers = {
+            endpoint: AimdRateController(start_rate, min_rate, max_rate,
+                                         settings.getfloat('ENDPOINT_THROTTLE_INCREASE', 0.05),
+                                         settings.getfloat('ENDPOINT_THROTTLE_DECREASE', 0.5),
+                                         settings.getfloat('ENDPOINT_THROTTLE_TARGET_LATENCY', 2.0))
+            for endpoint, (start_rate, max_rate) in settings.getdict('ENDPOINT_THROTTLE_RATES').items()
+        }
+        self.paused_until = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        endpoint = request.meta.get('throttle_endpoint')
+        if endpoint is None:
+            endpoint = request_endpoint(request, self.controllers)
+            if endpoint is None:
+                return None
+            request.meta['throttle_endpoint'] = endpoint
+            request.meta['download_slot'] = f"{urlparse_cached(request).hostname}/{endpoint}"
+        self._update_slot(request.meta['download_slot'], endpoint)
+        return None
+
+    def process_response(self, request, response, spider):
+        endpoint = request.meta.get('throttle_endpoint')
+        if endpoint is None or 'cached' in response.flags:
+            return response
+
+        controller = self.controllers[endpoint]
+        if response.status in THROTTLING_STATUS_CODES:
+            controller.on_throttled()
+            self.stats.inc_value(f'throttle/{endpoint}/throttled_responses')
+            retry_after = self._retry_after(response)
+            if retry_after:
+                logger.info(f"{endpoint} requests are paused for {retry_after:.0f}s as asked by Retry-After")
+                self.paused_until[endpoint] = max(self.paused_until.get(endpoint, 0), time.time() + retry_after)
+                self.stats.inc_value(f'throttle/{endpoint}/retry_after_pauses')
+                self.crawler.signals.send_catch_log(endpoint_paused, endpoint=endpoint,
+                                                    until=self.paused_until[endpoint])
+        elif request.meta.get('download_latency') is not None:
+            controller.on_response(request.meta['download_latency'])
+        self._update_slot(request.meta.get('download_slot'), endpoint)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        endpoint = request.meta.get('throttle_endpoint')
+        if endpoint is not None:
+            # Timeouts and dropped connections are as much a sign of overload as a 503
+            self.controllers[endpoint].on_throttled()
+            self._update_slot(request.meta.get('download_slot'), endpoint)
+
+    def _update_slot(self, key, endpoint):
+        controller = self.controllers[endpoint]
+        slots = self.crawler.engine.downloader.slots
+        if key not in slots:
+            # Created here rather than by the downloader so that the first request already gets the endpoint's delay
+            slots[key] = Slot(self.slot_concurrency, controller.delay, self.randomize_delay)
+        slots[key].delay = controller.delay
+        # The downloader sends nothing from a slot before lastseen + delay, which stretches that over the pause
+        slots[key].lastseen = max(slots[key].lastseen, self.paused_until.get(endpoint, 0))
+        self.stats.set_value(f'throttle/{endpoint}/rate', round(controller.rate, 3))
+
+    def _retry_after(self, response):
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        value = value.decode('latin-1').strip()
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(max(seconds, 0), self.max_retry_after)
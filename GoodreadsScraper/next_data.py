@@ -0,0 +1,47 @@
+"""Pull the __NEXT_DATA__ JSON blob out of new style Goodreads pages without building a DOM
+
+New style pages are rendered by Next.js, and everything we care about lives in a single
+<script id="__NEXT_DATA__" type="application/json"> tag. Finding that tag in the raw bytes and handing it straight to
+the JSON decoder is a lot cheaper than parsing the whole document with lxml first.
+"""
+import json
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+NEXT_DATA_MARKER = b'id="__NEXT_DATA__"'
+
+
+def find_next_data(body):
+    """Return the raw contents of the __NEXT_DATA__ script tag, or None if the page doesn't have one"""
+    marker = body.find(NEXT_DATA_MARKER)
+    if marker == -1:
+        return None
+
+    # Make sure the marker is an attribute of a <script> tag and not just some text on the page
+    tag_start = body.rfind(b"<", 0, marker)
+    if tag_start == -1 or not body.startswith(b"<script", tag_start):
+        return None
+
+    content_start = body.find(b">", marker)
+    if content_start == -1:
+        return None
+    content_end = body.find(b"</script>", content_start)
+    if content_end == -1:
+        return None
+    return body[content_start + 1:content_end]
+
+
+def load_next_data(body):
+    """Decode the __NEXT_DATA__ blob of a page, returning None if it is missing or not valid JSON"""
+    raw_next_data = find_next_data(body)
+    if raw_next_data is None:
+        return None
+    try:
+        return _json_loads(raw_next_data)
+    except ValueError:
+        return None
@@ -0,0 +1,74 @@
+"""Process pool for the CPU heavy part of spider callbacks
+
+A crawl runs in a single process, so once downloads are fast enough, decoding and extracting pages leaves the reactor
+and everything else fighting over one core. Spiders can hand the raw response body to a module level parse function
+running in a ParsePool worker instead, and only keep the bookkeeping that needs spider state (deduplication, paging,
+stats) in the crawl process. Parse functions have to be importable and picklable, just like their arguments and
+results, and get a copy of the response rather than the response itself.
+"""
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from scrapy import signals
+from scrapy.http import HtmlResponse
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+logger = logging.getLogger(__name__)
+
+
+def rebuild_response(url, body, encoding):
+    """The worker side copy of a response, as sent by ParsePool.submit_response"""
+    return HtmlResponse(url, body=body, encoding=encoding)
+
+
+def _parse_response(parse_function, url, body, encoding, args):
+    return parse_function(rebuild_response(url, body, encoding), *args)
+
+
+class ParsePool(object):
+    """Runs parse functions in PARSE_POOL_WORKERS worker processes, handing results back to the reactor as Deferreds
+
+    Workers are started with "spawn", forking a process that runs a reactor and thread pools is asking for trouble.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """The pool for a spider, or None if PARSE_POOL_WORKERS is 0 and callbacks should parse in-process"""
+        workers = crawler.settings.getint("PARSE_POOL_WORKERS", 0)
+        if workers <= 0:
+            return None
+        pool = cls(workers)
+        crawler.signals.connect(pool.spider_closed, signal=signals.spider_closed)
+        logger.info(f"Parsing responses in {workers} worker processes")
+        return pool
+
+    def spider_closed(self, spider):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, parse_function, *args):
+        """Run parse_function(*args) in a worker, the returned Deferred fires with its result"""
+        d = Deferred()
+        future = self.executor.submit(parse_function, *args)
+        # Futures call back from a pool management thread, Deferreds may only be fired from the reactor thread
+        future.add_done_callback(lambda f: reactor.callFromThread(self._fire, d, f))
+        return d
+
+    def submit_response(self, parse_function, response, *args):
+        """Run parse_function(response, *args) in a worker on a copy of the response"""
+        return self.submit(_parse_response, parse_function, response.url, response.body, response.encoding, args)
+
+    @staticmethod
+    def _fire(d, future):
+        if future.cancelled():
+            d.cancel()
+        elif future.exception() is not None:
+            d.errback(Failure(future.exception()))
+        else:
+            d.callback(future.result())
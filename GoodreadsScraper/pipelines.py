@@ -1,57 +1,321 @@
 # -*- coding: utf-8 -*-
+import datetime
+import gzip
+import io
 import json
 import logging
+import os
+import time
 from typing import List
 
-from google.cloud import tasks_v2
 from scrapy import signals
+from scrapy.exceptions import NotConfigured
 # Define your item pipelines here
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 from scrapy.exporters import JsonLinesItemExporter
+from scrapy.utils.misc import load_object
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, DeferredSemaphore, succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 
-from GoodreadsScraper.items import UserProfileItem
+from GoodreadsScraper.dates import TIME_FORMAT
+from GoodreadsScraper.items import UserProfileItem, BookItem, LegacyBookItem
+from dao.cloud_tasks_dao import CloudTasksDao
+from dao.recrawl_state_dao import RecrawlStateDao
 
 logger = logging.getLogger(__name__)
 
+# Fixed column types of the Parquet files, per item type. Legacy and new style books share the "book" files
+PARQUET_SCHEMAS = {
+    "book": [
+        ("url", "string"), ("title", "string"), ("author", "string"), ("author_url", "string"),
+        ("num_ratings", "int64"), ("num_reviews", "int64"), ("avg_rating", "float64"), ("num_pages", "int64"),
+        ("language", "string"), ("publish_date", "timestamp"),
+        ("isbn", "string"), ("isbn13", "string"), ("asin", "string"), ("series", "string"),
+        ("genres", "list<string>"), ("rating_histogram", "string"),
+    ],
+    "author": [
+        ("url", "string"), ("name", "string"), ("birth_date", "timestamp"), ("death_date", "timestamp"),
+        ("avg_rating", "float64"), ("num_ratings", "int64"), ("num_reviews", "int64"),
+        ("genres", "list<string>"), ("influences", "list<string>"), ("about", "string"),
+    ],
+    "userreview": [
+        ("user_id", "string"), ("user_id_slug", "string"), ("book_link", "string"), ("book_name", "string"),
+        ("author_link", "string"), ("author_name", "string"), ("date_read", "timestamp"), ("date_added", "timestamp"),
+        ("user_rating", "int64"),
+    ],
+    "userprofile": [
+        ("profile_url", "string"),
+    ],
+}
+PARQUET_ITEM_TYPES = {"BookItem": "book", "LegacyBookItem": "book", "AuthorItem": "author",
+                      "UserReviewItem": "userreview", "UserProfileItem": "userprofile"}
+
+
+def _parse_timestamp(value):
+    return datetime.datetime.strptime(value, TIME_FORMAT)
+
+
+# Turns the scraped value into one that fits the column type, the author pages for instance give counts as strings
+PARQUET_COERCERS = {
+    "string": str,
+    "int64": int,
+    "float64": float,
+    "timestamp": _parse_timestamp,
+    "list<string>": lambda values: [str(value) for value in values],
+}
+
+
+class JsonLinesSegment(object):
+    """One output file of the JsonLineItemSegregator, optionally gzip or zstd compressed while it is written"""
+
+    def __init__(self, path, compression, buffer_bytes):
+        self.path = path
+        self.raw = open(path, 'ab', buffering=buffer_bytes)
+        if compression == 'gzip':
+            compressed = gzip.GzipFile(fileobj=self.raw, mode='ab')
+        elif compression == 'zstd':
+            import zstandard
+            compressed = zstandard.ZstdCompressor().stream_writer(self.raw, closefd=False)
+        else:
+            compressed = None
+        # Compressing every exported line on its own would cost far more than compressing a large buffer of them
+        self.file = io.BufferedWriter(compressed, buffer_bytes) if compressed is not None else self.raw
+        self.exporter = JsonLinesItemExporter(self.file)
+        self.exporter.start_exporting()
+        self.items = 0
+        self.opened_at = time.time()
+
+    @property
+    def size(self):
+        """Bytes written to the file, in compressed form for compressed files"""
+        return self.raw.tell()
+
+    def export_item(self, item):
+        self.exporter.export_item(item)
+        self.items += 1
+
+    def close(self):
+        self.exporter.finish_exporting()
+        # Closing the compressing writers writes the end of the stream, but leaves the underlying file open
+        self.file.close()
+        self.raw.close()
+        return {"path": self.path, "items": self.items, "bytes": os.path.getsize(self.path),
+                "opened_at": self.opened_at, "closed_at": time.time()}
+
 
 class JsonLineItemSegregator(object):
+    """Writes books, authors, user profiles and user reviews to separate JSON lines files
+
+    A file is only created once the spider emits an item of its type. Output is buffered in JSONL_BUFFER_BYTES
+    chunks, and gzip or zstd compressed if JSONL_COMPRESSION is set. Without rotation every type is appended to a
+    single <type>_<OUTPUT_FILE_SUFFIX>.jl file. With JSONL_ROTATE_BYTES or JSONL_ROTATE_SECS set, each type is split
+    into numbered segments, and every finished segment is recorded in manifest_<OUTPUT_FILE_SUFFIX>.jl.
+    """
+    extensions = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
     @classmethod
     def from_crawler(cls, crawler):
         output_file_suffix = crawler.settings.get("OUTPUT_FILE_SUFFIX", default="")
         return cls(crawler, output_file_suffix)
 
     def __init__(self, crawler, output_file_suffix):
+        settings = crawler.settings
         self.types = {"book", "author", "userprofile", "userreview"}
         self.output_file_suffix = output_file_suffix
-        self.files = set()
-        self.exporters = None
+        self.compression = settings.get("JSONL_COMPRESSION") or None
+        if self.compression not in self.extensions:
+            raise NotConfigured(f"Unknown JSONL_COMPRESSION {self.compression!r}, use 'gzip' or 'zstd'")
+        self.buffer_bytes = settings.getint("JSONL_BUFFER_BYTES", 1024 * 1024)
+        self.rotate_bytes = settings.getint("JSONL_ROTATE_BYTES", 0)
+        self.rotate_secs = settings.getfloat("JSONL_ROTATE_SECS", 0)
+        self.stats = crawler.stats
+        self.segments = {}
+        self.segment_counts = {name: 0 for name in self.types}
+        self.started_at = None
         crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
         crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
 
-    def spider_opened(self, spider):
-        self.files = {name: open(name + "_" + self.output_file_suffix + '.jl', 'a+b') for name in self.types}
-        self.exporters = {name: JsonLinesItemExporter(self.files[name]) for name in self.types}
+    @property
+    def rotating(self):
+        return bool(self.rotate_bytes or self.rotate_secs)
 
-        for e in self.exporters.values():
-            e.start_exporting()
+    def spider_opened(self, spider):
+        # Part of segment file names, so that a later crawl with the same suffix does not overwrite earlier segments
+        self.started_at = time.strftime("%Y%m%dT%H%M%S")
 
     def spider_closed(self, spider):
-        for e in self.exporters.values():
-            e.finish_exporting()
-
-        for f in self.files.values():
-            f.close()
+        for name in list(self.segments):
+            self._close_segment(name)
 
     def process_item(self, item, spider):
         item_type = type(item).__name__.replace("Item", "").lower()
         if item_type in self.types:
-            self.exporters[item_type].export_item(item)
+            segment = self.segments.get(item_type)
+            if segment is None:
+                segment = self.segments[item_type] = self._open_segment(item_type)
+            segment.export_item(item)
+            if self.rotating and self._should_rotate(segment):
+                self._close_segment(item_type)
         return item
 
+    def _open_segment(self, name):
+        extension = '.jl' + self.extensions[self.compression]
+        if self.rotating:
+            self.segment_counts[name] += 1
+            path = f"{name}_{self.output_file_suffix}_{self.started_at}_{self.segment_counts[name]:05d}{extension}"
+        else:
+            path = name + "_" + self.output_file_suffix + extension
+        return JsonLinesSegment(path, self.compression, self.buffer_bytes)
+
+    def _should_rotate(self, segment):
+        if self.rotate_bytes and segment.size >= self.rotate_bytes:
+            return True
+        return bool(self.rotate_secs) and time.time() - segment.opened_at >= self.rotate_secs
+
+    def _close_segment(self, name):
+        entry = self.segments.pop(name).close()
+        entry.update(item_type=name, compression=self.compression)
+        self.stats.inc_value(f"jsonl/{name}/segments")
+        with open("manifest_" + self.output_file_suffix + ".jl", "a") as manifest:
+            manifest.write(json.dumps(entry) + "\n")
+
+
+class ParquetItemPipeline(object):
+    """Writes books, authors, user reviews and user profiles to Parquet files, one set of files per item type
+
+    Items are buffered column by column and written out as a row group once PARQUET_ROW_GROUP_SIZE of them have been
+    collected or the oldest buffered one is PARQUET_FLUSH_SECS old. A file is closed, and a new one started, after
+    PARQUET_ROW_GROUPS_PER_FILE row groups, so that finished files can be picked up while the crawl is still running.
+    Column types are fixed by PARQUET_SCHEMAS, values that don't fit their column are stored as null and counted in
+    the parquet/coercion_errors/<type>.<field> stats.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def __init__(self, crawler):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise NotConfigured("ParquetItemPipeline requires pyarrow")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.output_dir = settings.get("PARQUET_OUTPUT_DIR", ".")
+        self.output_file_suffix = settings.get("OUTPUT_FILE_SUFFIX", default="")
+        self.compression = settings.get("PARQUET_COMPRESSION", "zstd")
+        self.row_group_size = settings.getint("PARQUET_ROW_GROUP_SIZE", 100000)
+        self.row_groups_per_file = settings.getint("PARQUET_ROW_GROUPS_PER_FILE", 10)
+        self.flush_secs = settings.getfloat("PARQUET_FLUSH_SECS", 300)
+        self.schemas = {name: self._build_schema(columns) for name, columns in PARQUET_SCHEMAS.items()}
+        self.columns = {}
+        self.buffered_rows = {}
+        self.buffered_since = {}
+        self.writers = {}
+        self.row_groups = {}
+        self.file_counts = {}
+        self.started_at = None
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    def spider_opened(self, spider):
+        os.makedirs(self.output_dir, exist_ok=True)
+        # Part of every file name, so that a later crawl with the same suffix does not overwrite earlier files
+        self.started_at = time.strftime("%Y%m%dT%H%M%S")
+        for name in self.schemas:
+            self._reset_buffer(name)
+            self.file_counts[name] = 0
+
+    def spider_closed(self, spider):
+        for name in self.schemas:
+            self._flush(name)
+            self._close_file(name)
+
+    def process_item(self, item, spider):
+        name = PARQUET_ITEM_TYPES.get(type(item).__name__)
+        if name is None:
+            return item
+
+        columns = self.columns[name]
+        for field, column_type in PARQUET_SCHEMAS[name]:
+            columns[field].append(self._coerce(name, field, column_type, item.get(field)))
+        self.buffered_rows[name] += 1
+        if self.buffered_since[name] is None:
+            self.buffered_since[name] = time.monotonic()
+
+        # Checking every type here, not just this one, flushes rarely seen types on time as well
+        now = time.monotonic()
+        for buffered_name, buffered_since in list(self.buffered_since.items()):
+            if buffered_since is None:
+                continue
+            if self.buffered_rows[buffered_name] >= self.row_group_size or now - buffered_since >= self.flush_secs:
+                self._flush(buffered_name)
+        return item
+
+    def _build_schema(self, columns):
+        pa = self.pa
+        types = {"string": pa.string(), "int64": pa.int64(), "float64": pa.float64(), "timestamp": pa.timestamp("s"),
+                 "list<string>": pa.list_(pa.string())}
+        return pa.schema([(field, types[column_type]) for field, column_type in columns])
+
+    def _coerce(self, name, field, column_type, value):
+        if value is None:
+            return None
+        try:
+            return PARQUET_COERCERS[column_type](value)
+        except (TypeError, ValueError):
+            self.stats.inc_value(f"parquet/coercion_errors/{name}.{field}")
+            return None
+
+    def _reset_buffer(self, name):
+        self.columns[name] = {field: [] for field, _ in PARQUET_SCHEMAS[name]}
+        self.buffered_rows[name] = 0
+        self.buffered_since[name] = None
+
+    def _flush(self, name):
+        """Write the buffered items of a type out as one row group"""
+        if not self.buffered_rows[name]:
+            return
+        table = self.pa.Table.from_pydict(self.columns[name], schema=self.schemas[name])
+        rows = self.buffered_rows[name]
+        self._reset_buffer(name)
+
+        if name not in self.writers:
+            self.file_counts[name] += 1
+            file_name = f"{name}_{self.output_file_suffix}_{self.started_at}_{self.file_counts[name]:05d}.parquet"
+            path = os.path.join(self.output_dir, file_name)
+            self.writers[name] = self.pq.ParquetWriter(path, self.schemas[name], compression=self.compression)
+            self.row_groups[name] = 0
+        self.writers[name].write_table(table, row_group_size=rows)
+        self.row_groups[name] += 1
+        self.stats.inc_value(f"parquet/{name}/rows", rows)
+        self.stats.inc_value(f"parquet/{name}/row_groups")
+
+        if self.row_groups[name] >= self.row_groups_per_file:
+            self._close_file(name)
+
+    def _close_file(self, name):
+        writer = self.writers.pop(name, None)
+        if writer is not None:
+            writer.close()
+            self.stats.inc_value(f"parquet/{name}/files")
+
 
 class GcpTaskQueuePipeline(object):
+    """Batches scraped profiles into Cloud Tasks for the user review scraper pool
+
+    Creating a task is a blocking RPC, so it runs on a small dedicated thread pool instead of the reactor thread, with
+    at most GCP_TASKS_MAX_IN_FLIGHT batches being submitted at once. When that many are in flight, process_item
+    returns a Deferred that only fires once a slot frees up, which makes Scrapy hold back further items.
+    """
+
     @classmethod
     def from_crawler(cls, crawler):
         return cls(crawler)
@@ -59,45 +323,97 @@ class GcpTaskQueuePipeline(object):
     def __init__(self, crawler):
         self.pipeline_name = "profile-scrape-queue"
         self.http_target = "https://user-review-scraper-pool-tmzffqb3oq-ue.a.run.app/scrape-users"
-        self.client = None
-        self.parent = None
+        self.stats = crawler.stats
+        self.client_cls = crawler.settings.get("GCP_TASKS_CLIENT")
+        self.max_retries = crawler.settings.getint("GCP_TASKS_MAX_RETRIES", 3)
+        self.thread_pool_size = crawler.settings.getint("GCP_TASKS_THREADS", 4)
+        self.max_in_flight = crawler.settings.getint("GCP_TASKS_MAX_IN_FLIGHT", 8)
+        self.dao = None
+        self.thread_pool = None
+        self.semaphore = None
+        self.in_flight = set()
         self.item_list: List[UserProfileItem] = []
         self.number_of_profiles_per_crawl = 5
         crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
         crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
 
     def spider_opened(self, spider):
-        self.client = tasks_v2.CloudTasksClient()
-        self.parent = self.client.queue_path("book-suggestion-please", "us-east1", self.pipeline_name)
+        client = load_object(self.client_cls)() if self.client_cls else None
+        self.dao = CloudTasksDao(self.pipeline_name, self.http_target, client=client, max_retries=self.max_retries)
+        self.thread_pool = ThreadPool(minthreads=0, maxthreads=self.thread_pool_size, name="gcp-tasks")
+        self.thread_pool.start()
+        self.semaphore = DeferredSemaphore(self.max_in_flight)
 
     def spider_closed(self, spider):
-        self.send_task()
+        # The semaphore hands out slots in order, so once the last batch has one every other batch is in flight
+        flushed = self.send_task()
+        flushed.addCallback(lambda _: DeferredList(list(self.in_flight)))
+        flushed.addBoth(lambda _: self.thread_pool.stop())
+        return flushed
 
     def process_item(self, item, spider):
         self.item_list.append(item)
-        if len(self.item_list) >= self.number_of_profiles_per_crawl:
-            self.send_task()
+        if len(self.item_list) < self.number_of_profiles_per_crawl:
+            return item
+        return self.send_task().addCallback(lambda _: item)
 
     def send_task(self):
-        task = {
-            "http_request": {  # Specify the type of request.
-                "http_method": tasks_v2.HttpMethod.POST,
-                "url": self.http_target,  # The full url path that the task will be sent to.
-            }
-        }
-        if len(self.item_list) > 0:
-            user_profile_list = [item['profile_url'] for item in self.item_list]
-            # Convert list to JSON query
-            payload = json.dumps({"profiles": user_profile_list})
-            # specify http content-type to application/json
-            task["http_request"]["headers"] = {"Content-type": "application/json"}
-
-            # The API expects a payload of type bytes.
-            converted_payload = payload.encode()
-
-            # Add the payload to the request.
-            task["http_request"]["body"] = converted_payload
-
-            response = self.client.create_task(request={"parent": self.parent, "task": task})
-            logger.info("Created task {}".format(response.name))
-            self.item_list = []
+        """Submit the pending profiles, the returned Deferred fires once the batch has an in-flight slot"""
+        if not self.item_list:
+            return succeed(None)
+        user_profile_list = [item['profile_url'] for item in self.item_list]
+        self.item_list = []
+        return self.semaphore.acquire().addCallback(self._submit, user_profile_list)
+
+    def _submit(self, semaphore, user_profile_list):
+        d = deferToThreadPool(reactor, self.thread_pool, self.dao.create_task, {"profiles": user_profile_list})
+        d.addCallbacks(self._task_created, self._task_failed, errbackArgs=(user_profile_list,))
+        d.addBoth(self._release, d)
+        self.in_flight.add(d)
+
+    def _task_created(self, task_name):
+        logger.info("Created task {}".format(task_name))
+        self.stats.inc_value("gcp_tasks/created")
+
+    def _task_failed(self, failure, user_profile_list):
+        logger.error(f"Giving up on creating a task for {user_profile_list}: {failure.getErrorMessage()}")
+        self.stats.inc_value("gcp_tasks/failed")
+
+    def _release(self, result, d):
+        self.in_flight.discard(d)
+        self.semaphore.release()
+        return result
+
+
+class RecrawlStatePipeline(object):
+    """Records the scrape time, num_ratings and num_reviews of every book for ad_hoc_scripts/recrawl_scheduler.py"""
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        state_db = crawler.settings.get("RECRAWL_STATE_DB")
+        if not state_db:
+            raise NotConfigured("RECRAWL_STATE_DB is not set")
+        return cls(crawler, state_db, crawler.settings.getint("RECRAWL_STATE_COMMIT_EVERY", 100))
+
+    def __init__(self, crawler, state_db, commit_every):
+        self.state_db = state_db
+        self.commit_every = commit_every
+        self.dao = None
+        self.uncommitted = 0
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    def spider_opened(self, spider):
+        self.dao = RecrawlStateDao(self.state_db)
+
+    def spider_closed(self, spider):
+        self.dao.close()
+
+    def process_item(self, item, spider):
+        if isinstance(item, (BookItem, LegacyBookItem)) and item.get("url"):
+            self.dao.record(item["url"], item.get("num_ratings"), item.get("num_reviews"))
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.dao.commit()
+                self.uncommitted = 0
+        return item
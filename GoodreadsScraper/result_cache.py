@@ -0,0 +1,132 @@
+"""In-process cache of scrape results for the web app, with request coalescing
+
+Duplicate Cloud Tasks deliveries and overlapping batches keep asking for books and profiles that were just scraped, or
+that another request is scraping right now. Results are cached per canonical ID for a TTL, with the least recently used
+entries evicted beyond a size limit, and a request for an ID that is already being scraped waits for that scrape
+instead of starting its own.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class CacheEntry(object):
+    __slots__ = ("value", "expires_at", "claims")
+
+    def __init__(self, value, expires_at):
+        self.value = value
+        self.expires_at = expires_at
+        self.claims = set()
+
+
+class CoalescingCache(object):
+    """TTL and size bounded cache, which fetches every missing key only once however many callers want it
+
+    Counters: `hits` for fresh cached values, `coalesced` for keys that were already being fetched by another caller,
+    `misses` for keys a caller had to fetch itself, and `evictions`/`expirations` for dropped entries.
+    """
+
+    def __init__(self, ttl_secs=600, max_entries=10000):
+        self.ttl_secs = ttl_secs
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "expirations": 0}
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(ttl_secs=settings.getfloat("SCRAPE_CACHE_TTL_SECS", 600),
+                   max_entries=settings.getint("SCRAPE_CACHE_MAX_ENTRIES", 10000))
+
+    def get_many(self, keys, fetch):
+        """Return a {key: value} dict for the keys, calling fetch(missing_keys) for the ones nobody has fetched yet
+
+        fetch must return a {key: value} dict, keys it leaves out are returned as None and not cached. If it raises,
+        the exception is raised to every caller waiting for those keys.
+        """
+        values = {}
+        waiting = {}
+        owned = {}
+        now = time.time()
+        with self.lock:
+            for key in dict.fromkeys(keys):
+                entry = self._fresh_entry(key, now)
+                if entry is not None:
+                    self.counters["hits"] += 1
+                    values[key] = entry.value
+                elif key in self.in_flight:
+                    self.counters["coalesced"] += 1
+                    waiting[key] = self.in_flight[key]
+                else:
+                    self.counters["misses"] += 1
+                    owned[key] = self.in_flight[key] = Future()
+
+        if owned:
+            values.update(self._fetch(owned, fetch))
+        for key, future in waiting.items():
+            values[key] = future.result()
+        return values
+
+    def claim(self, keys, name):
+        """Return the keys whose cached values weren't claimed for `name` yet, and claim them
+
+        Lets callers do something once per cached value, like persisting it, however many times it is handed out.
+        """
+        claimed = []
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                entry = self._fresh_entry(key, now)
+                if entry is None or name not in entry.claims:
+                    claimed.append(key)
+                    if entry is not None:
+                        entry.claims.add(name)
+        return claimed
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), in_flight=len(self.in_flight))
+
+    def _fetch(self, owned, fetch):
+        try:
+            fetched = fetch(list(owned))
+        except Exception as e:
+            with self.lock:
+                for key, future in owned.items():
+                    del self.in_flight[key]
+                    future.set_exception(e)
+            raise
+
+        values = {}
+        expires_at = time.time() + self.ttl_secs
+        with self.lock:
+            for key, future in owned.items():
+                value = fetched.get(key)
+                if value is not None:
+                    self.entries[key] = CacheEntry(value, expires_at)
+                    self.entries.move_to_end(key)
+                del self.in_flight[key]
+                future.set_result(value)
+                values[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+        return values
+
+    def _fresh_entry(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= now:
+            del self.entries[key]
+            self.counters["expirations"] += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry
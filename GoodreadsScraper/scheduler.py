@@ -0,0 +1,204 @@
+"""Scheduler that keeps requests out of the downloader while they can't be downloaded anyway
+
+Requests handed to the downloader count against CONCURRENT_REQUESTS for as long as they wait for their download slot.
+A few dozen requests of an endpoint that EndpointThrottleMiddleware paused for a Retry-After, or reloads that a spider
+wants to back off, would be enough to keep every other request from being downloaded in the meantime. The
+DeferringScheduler puts such requests aside instead, and hands them out once they can go.
+
+With a JOBDIR and a CheckpointFifoDiskQueue as SCHEDULER_DISK_QUEUE, it also checkpoints the crawl every
+SCHEDULER_CHECKPOINT_SECS: the state of the disk queues, the requests that were handed out but aren't done yet, and
+then the dupefilter, in that order. Requests are never marked as seen in a saved dupefilter without being in the saved
+frontier, so a crawl that gets killed resumes from the last checkpoint, re-crawling at most what was crawled since.
+"""
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import time
+import weakref
+
+from scrapy.core.scheduler import Scheduler
+from scrapy.utils.log import failure_to_exc_info
+from scrapy.utils.reqser import request_from_dict, request_to_dict
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from .middlewares import endpoint_paused, request_endpoint
+from .squeues import CheckpointFifoDiskQueue, remove_queues
+
+logger = logging.getLogger(__name__)
+
+
+class DeferringScheduler(Scheduler):
+    """Scheduler which holds back requests, in memory, until their endpoint's pause is over
+
+    Requests with a `not_before` meta key, a timestamp, are held back until then as well, which lets spiders delay a
+    request without blocking anything. At most SCHEDULER_MAX_HELD_REQUESTS requests are held, further ones are handed out anyway and wait in their
+    download slot. Held requests are put back into the queues when the crawl is closed, so a JOBDIR keeps them.
+    """
+
+    def __init__(self, *args, max_held=10000, checkpoint_secs=60, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_held = max_held
+        self.checkpoint_secs = checkpoint_secs
+        self.checkpointing = self.dqdir is not None and self.dqclass is not None and \
+            issubclass(self.dqclass, CheckpointFifoDiskQueue)
+        self.checkpoint_path = os.path.join(self.dqdir, 'checkpoint.pickle') if self.checkpointing else None
+        self.checkpoint_loop = None
+        self.restored = None
+        # Requests handed out to the engine, they drop out once nothing refers to them anymore
+        self.handed_out = weakref.WeakSet()
+        # (release time, sequence number, request) heap, the sequence keeps requests with the same time in order
+        self.held = []
+        self.sequence = itertools.count()
+        self.paused_until = {}
+        self.wakeup = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super().from_crawler(crawler)
+        scheduler.max_held = crawler.settings.getint('SCHEDULER_MAX_HELD_REQUESTS', scheduler.max_held)
+        scheduler.checkpoint_secs = crawler.settings.getfloat('SCHEDULER_CHECKPOINT_SECS', scheduler.checkpoint_secs)
+        crawler.signals.connect(scheduler.endpoint_paused, signal=endpoint_paused)
+        return scheduler
+
+    def endpoint_paused(self, endpoint, until):
+        self.paused_until[endpoint] = max(self.paused_until.get(endpoint, 0), until)
+
+    def release_time(self, request):
+        """When the request can be downloaded, or None if it can be right away"""
+        until = request.meta.get('not_before') or 0
+        endpoint = request_endpoint(request)
+        if endpoint is not None:
+            until = max(until, self.paused_until.get(endpoint, 0))
+        return until if until > time.time() else None
+
+    def open(self, spider):
+        if self.checkpointing:
+            self.restored = self._restore_checkpoint()
+        result = super().open(spider)
+        if self.restored is not None:
+            for request_dict in self.restored['pending']:
+                request = request_from_dict(request_dict, spider)
+                # Already marked as seen, so they go straight into the queues
+                if not self._dqpush(request):
+                    self._mqpush(request)
+            logger.info(f"Resuming from the checkpoint in {self.checkpoint_path}, "
+                        f"with {len(self.restored['pending'])} requests that were in progress")
+        if self.checkpointing and self.checkpoint_secs > 0:
+            self.checkpoint_loop = LoopingCall(self.checkpoint)
+            self.checkpoint_loop.start(self.checkpoint_secs, now=False).addErrback(
+                lambda failure: logger.error("Checkpointing stopped", exc_info=failure_to_exc_info(failure)))
+        return result
+
+    def next_request(self):
+        request = self._next_request()
+        self._schedule_wakeup()
+        if request is not None and self.checkpointing:
+            self.handed_out.add(request)
+        return request
+
+    def _next_request(self):
+        now = time.time()
+        while self.held and self.held[0][0] <= now:
+            request = heapq.heappop(self.held)[2]
+            release_time = self.release_time(request)
+            if release_time is None:
+                self.stats.inc_value('scheduler/held/released', spider=self.spider)
+                return request
+            self._hold(request, release_time)
+
+        while True:
+            request = super().next_request()
+            if request is None:
+                return None
+            release_time = self.release_time(request)
+            if release_time is None or len(self.held) >= self.max_held:
+                return request
+            self._hold(request, release_time)
+
+    def close(self, reason):
+        if self.wakeup is not None and self.wakeup.active():
+            self.wakeup.cancel()
+        if self.checkpoint_loop is not None and self.checkpoint_loop.running:
+            self.checkpoint_loop.stop()
+        for _, _, request in self.held:
+            if not self._dqpush(request):
+                self._mqpush(request)
+        self.held = []
+        if self.checkpointing:
+            self.checkpoint()
+        return super().close(reason)
+
+    def checkpoint(self):
+        """Save the frontier, and then the dupefilter, for a crawl that gets killed to resume from"""
+        queues = {str(priority): queue.snapshot() for priority, queue in self.dqs.queues.items()}
+        pending = []
+        in_progress = self.crawler.engine.slot.inprogress
+        for request in [request for request in self.handed_out if request in in_progress] + \
+                       [request for _, _, request in self.held]:
+            try:
+                pending.append(request_to_dict(request, self.spider))
+            except ValueError:
+                # Requests the disk queues couldn't take either, which no JOBDIR keeps
+                self.stats.inc_value('scheduler/checkpoint/unserializable', spider=self.spider)
+
+        # Written to a temporary file first so a crash mid-write leaves the previous checkpoint in place
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as checkpoint_file:
+            pickle.dump({'queues': queues, 'pending': pending}, checkpoint_file, protocol=4)
+        os.replace(tmp_path, self.checkpoint_path)
+        flush = getattr(self.df, 'flush', None)
+        if flush is not None:
+            flush()
+
+        # Only now that no checkpoint points to them anymore
+        for name, state in queues.items():
+            self.dqclass.discard_consumed(os.path.join(self.dqdir, name), state)
+        remove_queues(self.dqdir, keep=queues)
+        self.stats.inc_value('scheduler/checkpoints', spider=self.spider)
+        logger.debug(f"Checkpointed {len(self.dqs)} queued and {len(pending)} pending requests")
+
+    def _restore_checkpoint(self):
+        checkpoint = None
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'rb') as checkpoint_file:
+                checkpoint = pickle.load(checkpoint_file)
+        queues = checkpoint['queues'] if checkpoint is not None else {}
+        for name, state in queues.items():
+            self.dqclass.restore(os.path.join(self.dqdir, name), state)
+        # Queue files of a crawl that was killed before its first checkpoint hold nothing it could resume from
+        remove_queues(self.dqdir, keep=queues)
+        return checkpoint
+
+    def _read_dqs_state(self, dqdir):
+        if self.checkpointing:
+            # The priorities of the queues in the checkpoint, rather than the ones left by the last clean close
+            return [int(name) for name in self.restored['queues']] if self.restored is not None else ()
+        return super()._read_dqs_state(dqdir)
+
+    def __len__(self):
+        return super().__len__() + len(self.held)
+
+    def _hold(self, request, release_time):
+        heapq.heappush(self.held, (release_time, next(self.sequence), request))
+        self.stats.inc_value('scheduler/held', spider=self.spider)
+
+    def _schedule_wakeup(self):
+        if not self.held:
+            return
+        release_time = self.held[0][0]
+        if self.wakeup is not None and self.wakeup.active():
+            if self.wakeup.getTime() <= release_time:
+                return
+            self.wakeup.cancel()
+        self.wakeup = reactor.callLater(max(0.0, release_time - time.time()), self._wake)
+
+    def _wake(self):
+        self.wakeup = None
+        # The engine only asks for more requests when a download finishes or on its heartbeat every few seconds.
+        # Asking makes next_request schedule the wakeup for whatever is held next
+        slot = getattr(self.crawler.engine, 'slot', None)
+        if slot is not None:
+            slot.nextcall.schedule()
@@ -52,9 +52,41 @@ DOWNLOAD_DELAY = 1
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'GoodreadsScraper.middlewares.MyCustomDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    # Shares parsed robots.txt files between the crawls the web app runs in-process
+    'scrapy.downloadermiddlewares.robotstxt.RobotsTxtMiddleware': None,
+    'GoodreadsScraper.middlewares.SharedRobotsTxtMiddleware': 100,
+    # Sits below the retry middleware so it sees 429/503 responses before they are retried
+    'GoodreadsScraper.middlewares.EndpointThrottleMiddleware': 800,
+}
+
+# Keeps requests of endpoints paused by a Retry-After, and BookSpider reloads that are backed off, out of the
+# downloader, where they would take up the CONCURRENT_REQUESTS of everything else. At most
+# SCHEDULER_MAX_HELD_REQUESTS of them are held in memory
+SCHEDULER = 'GoodreadsScraper.scheduler.DeferringScheduler'
+SCHEDULER_MAX_HELD_REQUESTS = 10000
+# How often the scheduler saves the frontier of a JOBDIR crawl with a CheckpointFifoDiskQueue, in seconds. A killed
+# crawl re-crawls what it crawled since
+SCHEDULER_CHECKPOINT_SECS = 60
+
+# Separate adaptive request rates for each kind of Goodreads page, see EndpointThrottleMiddleware.
+# Rates are in requests per second as (start, max), anything not listed here keeps using DOWNLOAD_DELAY
+ENDPOINT_THROTTLE_ENABLED = True
+ENDPOINT_THROTTLE_RATES = {
+    'book': (1.0, 4.0),
+    'author': (1.0, 2.0),
+    'review_list': (0.5, 2.0),
+    'user_profile': (1.0, 4.0),
+    'sitemap': (2.0, 8.0),
+}
+ENDPOINT_THROTTLE_MIN_RATE = 0.1
+# Responses slower than this (in seconds) lower the rate, faster ones raise it by ENDPOINT_THROTTLE_INCREASE
+ENDPOINT_THROTTLE_TARGET_LATENCY = 2.0
+ENDPOINT_THROTTLE_INCREASE = 0.05
+# Factor the rate is multiplied with on 429/503 responses and download errors
+ENDPOINT_THROTTLE_DECREASE = 0.5
+# Longest Retry-After pause that is honoured, in seconds
+ENDPOINT_THROTTLE_MAX_RETRY_AFTER = 600
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
@@ -66,8 +98,62 @@ DOWNLOAD_DELAY = 1
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
     # 'GoodreadsScraper.pipelines.JsonLineItemSegregator': 300,
+    # 'GoodreadsScraper.pipelines.ParquetItemPipeline': 310,
+    # 'GoodreadsScraper.pipelines.RecrawlStatePipeline': 500,
 }
 
+# Output of the JsonLineItemSegregator. JSONL_COMPRESSION may be 'gzip' or 'zstd' (needs zstandard). With either
+# rotation threshold set (bytes on disk, seconds) each item type is split into numbered segment files, finished
+# segments are listed in manifest_<OUTPUT_FILE_SUFFIX>.jl
+JSONL_COMPRESSION = None
+JSONL_BUFFER_BYTES = 1024 * 1024
+JSONL_ROTATE_BYTES = 0
+JSONL_ROTATE_SECS = 0
+
+# Output of the ParquetItemPipeline (needs pyarrow): one set of <type>_<OUTPUT_FILE_SUFFIX>_<start time>_<n>.parquet
+# files per item type. Buffered items are written as a row group once there are PARQUET_ROW_GROUP_SIZE of them or the
+# oldest is PARQUET_FLUSH_SECS seconds old, and a file is finished after PARQUET_ROW_GROUPS_PER_FILE row groups
+PARQUET_OUTPUT_DIR = '.'
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_ROW_GROUP_SIZE = 100000
+PARQUET_FLUSH_SECS = 300
+PARQUET_ROW_GROUPS_PER_FILE = 10
+
+# SQLite file the RecrawlStatePipeline keeps the book recrawl state in
+RECRAWL_STATE_DB = 'recrawl_state.sqlite3'
+
+# How often BookSpider reloads a page that came back without its book data, and the delay before the first reload
+# in seconds (doubled for every further one). Pages with the legacy markup are parsed with the legacy selectors instead
+BOOK_SOFT_RETRY_TIMES = 3
+BOOK_SOFT_RETRY_BACKOFF = 2.0
+BOOK_SOFT_RETRY_LEGACY_FALLBACK = True
+
+# Crawls the web app runs at once, more requests wait for a free slot. Asynchronous /jobs requests are queued, with at
+# most CRAWL_JOBS_MAX_QUEUED waiting, and finished jobs can be polled for CRAWL_JOBS_RETENTION_SECS seconds
+CRAWL_ENGINE_MAX_CRAWLS = 1
+CRAWL_JOBS_MAX_QUEUED = 100
+CRAWL_JOBS_RETENTION_SECS = 3600
+
+# Seconds the web app hands out the results of a book or profile scrape again instead of re-scraping it, and how many
+# books and profiles it keeps results for. Requests for a book or profile that is being scraped already always wait for
+# that scrape, even with a TTL of 0
+SCRAPE_CACHE_TTL_SECS = 600
+SCRAPE_CACHE_MAX_ENTRIES = 10000
+
+# Worker processes BookSpider and UserReviewsSpider hand response bodies to for parsing, so that decoding and item
+# extraction don't compete with the reactor for one core. 0 parses in the crawl process itself
+PARSE_POOL_WORKERS = 0
+
+# Review list pages of a single profile the UserReviewsSpider fetches at once, once it knows the size of the shelf
+USER_REVIEWS_PAGE_CONCURRENCY = 4
+
+# Cloud Tasks submission of the GcpTaskQueuePipeline: worker threads, batches submitted at once and retries per batch.
+# GCP_TASKS_CLIENT can point at a class to use instead of the real client, e.g. 'dao.fakes.InMemoryCloudTasksClient'
+GCP_TASKS_THREADS = 4
+GCP_TASKS_MAX_IN_FLIGHT = 8
+GCP_TASKS_MAX_RETRIES = 3
+# GCP_TASKS_CLIENT = None
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
 # AUTOTHROTTLE_ENABLED = False
@@ -87,10 +173,18 @@ ITEM_PIPELINES = {
 
 # Enable and configure HTTP caching (disabled by default)
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-#HTTPCACHE_ENABLED = True
-#HTTPCACHE_EXPIRATION_SECS = 0
-#HTTPCACHE_DIR = 'httpcache'
+# Only book and author pages are cached, see GoodreadsScraper/httpcache.py. Left off by default so that the web app,
+# which persists what it scrapes, always fetches live pages. Enable it for batch crawls with -s HTTPCACHE_ENABLED=True
+HTTPCACHE_ENABLED = False
+HTTPCACHE_EXPIRATION_SECS = 0
+HTTPCACHE_DIR = 'httpcache'
 #HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+HTTPCACHE_POLICY = 'GoodreadsScraper.httpcache.PageTypeCachePolicy'
+HTTPCACHE_STORAGE = 'GoodreadsScraper.httpcache.CompressedKeyValueCacheStorage'
+# Seconds a cached page is used without revalidation, page types not listed here are never cached
+HTTPCACHE_PAGE_TTLS = {
+    'book': 24 * 60 * 60,
+    'author': 7 * 24 * 60 * 60,
+}
 
 #LOG_LEVEL = 'INFO'
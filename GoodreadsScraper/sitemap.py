@@ -0,0 +1,61 @@
+"""Incremental parsing of (gzipped) sitemap files
+
+scrapy.utils.sitemap.Sitemap needs the fully decompressed document and builds a complete lxml tree before the first
+URL comes out. Goodreads user sitemap shards are big, so here the body is decompressed a chunk at a time and fed to
+a pull parser, and each <url>/<sitemap> entry is thrown away as soon as its <loc> has been read. Memory use per shard
+stays constant and the first URL is available before the shard has been fully decompressed.
+"""
+import zlib
+
+from lxml import etree
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_chunks(body, gzipped=False, chunk_size=CHUNK_SIZE):
+    """Yield the (decompressed) body in chunks of at most chunk_size bytes"""
+    view = memoryview(body)
+    if not gzipped:
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+        return
+
+    # 16 + MAX_WBITS makes zlib expect a gzip header and trailer
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for start in range(0, len(view), chunk_size):
+        # Capping the output keeps highly compressed input from blowing up in one go
+        yield decompressor.decompress(view[start:start + chunk_size], chunk_size)
+        while decompressor.unconsumed_tail:
+            yield decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+    yield decompressor.flush()
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def iter_sitemap_locs(body, gzipped=False):
+    """Yield (sitemap type, loc) tuples in document order
+
+    The sitemap type is the name of the root element, i.e. 'urlset' or 'sitemapindex'. Like Scrapy's Sitemap, only
+    <loc> elements that are direct children of an entry are considered, so e.g. <image:loc> is ignored.
+    """
+    parser = etree.XMLPullParser(events=("end",), tag="{*}loc", recover=True, remove_comments=True,
+                                 resolve_entities=False)
+
+    def read_events():
+        for _, loc in parser.read_events():
+            entry = loc.getparent()
+            root = entry.getparent() if entry is not None else None
+            if root is None or root.getparent() is not None:
+                continue
+            yield _local_name(root.tag), (loc.text or "").strip()
+            # We're done with the entries before this one, free them so the tree never grows past a single entry
+            while entry.getprevious() is not None:
+                del root[0]
+
+    for chunk in iter_chunks(body, gzipped):
+        parser.feed(bytes(chunk))
+        yield from read_events()
+    parser.close()
+    yield from read_events()
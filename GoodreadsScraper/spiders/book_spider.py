@@ -1,154 +1,245 @@
 """Spider to extract information from a /book/show type page on Goodreads"""
 import json
 import re
+import time
+from collections import defaultdict
 from urllib.parse import urlsplit
 
 import scrapy
+from lxml import etree
 from scrapy import Request
 
+from ..extractors import Extractor, Rule
 from ..items import LegacyBookItem, BookLoader, BookItem
+from ..next_data import load_next_data
+from ..parse_pool import ParsePool
 
 TYPENAME = "__typename"
 
-SIMILAR_EDITIONS_ISBN_REGEX = re.compile(r"editionInfo\\'>\\nisbn:\s(\d+)\\n<\\")
-SIMILAR_EDITIONS_ISBN_13_REGEX = re.compile(r"editionInfo\\'>\\nisbn13:\s(\d+)\\n<\\")
-SIMILAR_EDITIONS_ASIN_REGEX = re.compile(r"editionInfo\\'>\\nasin:\s([A-Za-z0-9]+)\\n<\\")
+# Tooltips of the other editions, e.g. editionInfo\'>\nisbn13: 9780316666343\n<\/div>. One regex for the three
+# identifiers means the scripts are scanned once, the isbn processors drop non-numeric matches for isbn/isbn13
+SIMILAR_EDITIONS_REGEX = re.compile(r"editionInfo\\'>\\n(isbn|isbn13|asin):\s([A-Za-z0-9]+)\\n<\\")
+
+LEGACY_BOOK_TITLE = etree.XPath('//*[@id="bookTitle"]')
+
+# I use relative paths for the url because that's what's in the reviews
+LEGACY_BOOK_EXTRACTOR = Extractor(LegacyBookItem, BookLoader, [
+    Rule("url"),
+
+    Rule("title", css="#bookTitle::text"),
+    Rule("author", css="a.authorName>span::text"),
+    Rule("author_url", css="a.authorName::attr(href)"),
+
+    Rule("num_ratings", css="[itemprop=ratingCount]::attr(content)"),
+    Rule("num_reviews", css="[itemprop=reviewCount]::attr(content)"),
+    Rule("avg_rating", css="span[itemprop=ratingValue]::text"),
+    Rule("num_pages", css="span[itemprop=numberOfPages]::text"),
+
+    Rule("language", css="div[itemprop=inLanguage]::text"),
+    Rule("publish_date", css="div.row::text"),
+    Rule("publish_date", css="nobr.greyText::text"),
+
+    Rule("genres", css='div.left>a.bookPageGenreLink[href*="/genres/"]::text'),
+    Rule("series", css='div.infoBoxRowItem>a[href*="/series/"]::text'),
+
+    Rule("asin", css="div.infoBoxRowItem[itemprop=isbn]::text"),
+    Rule("asin", css="script::text", regex=SIMILAR_EDITIONS_REGEX, key="asin"),
+    Rule("isbn", css="div.infoBoxRowItem[itemprop=isbn]::text"),
+    Rule("isbn", css="span[itemprop=isbn]::text"),
+    Rule("isbn", css="div.infoBoxRowItem::text"),
+    Rule("isbn", css="script::text", regex=SIMILAR_EDITIONS_REGEX, key="isbn"),
+    Rule("isbn13", css="div.infoBoxRowItem[itemprop=isbn]::text"),
+    Rule("isbn13", css="span[itemprop=isbn]::text"),
+    Rule("isbn13", css="div.infoBoxRowItem::text"),
+    Rule("isbn13", css="script::text", regex=SIMILAR_EDITIONS_REGEX, key="isbn13"),
+
+    Rule("rating_histogram", css='script[type*="protovis"]::text'),
+])
+
+
+def parse_book_page(response, url, legacy_fallback=True):
+    """Extract the book of a /book/show page, as an (item, reason) tuple
+
+    `reason` says why the page has no usable book data, in which case the item is None, or is parsed from the legacy
+    markup instead when `legacy_fallback` is set and the page has it. This only depends on the response, so it can run
+    in a ParsePool worker.
+    """
+    # New style pages are recognised by their __NEXT_DATA__ blob straight from the raw bytes, the selector based
+    # checks below only run for legacy pages or pages where the fast path couldn't find or decode the blob
+    next_data = load_next_data(response.body)
+    if next_data is None:
+        if response.selector.attrib.get('class', "").startswith("desktop withSiteHeaderTopFullImage"):
+            return parse_legacy_book_page(response, url), None
+        text_body = response.xpath('//*[@id="__NEXT_DATA__"]/text()').get()
+        if text_body is not None:
+            next_data = json.loads(text_body)
+
+    item, reason = extract_book(next_data, url) if next_data is not None else (None, "wrong_layout")
+    if reason is not None and legacy_fallback and LEGACY_BOOK_TITLE(response.selector.root):
+        return parse_legacy_book_page(response, url), reason
+    return item, reason
+
+
+def parse_legacy_book_page(response, url):
+    return LEGACY_BOOK_EXTRACTOR.extract(response.selector.root, url=url)
+
+
+def extract_book(next_data, url):
+    """Build the BookItem from the decoded __NEXT_DATA__ blob of a page, as an (item, reason) tuple"""
+    book_info = next_data.get('props', {}).get('pageProps', {}).get('apolloState')
+    if not book_info:
+        return None, "empty_apollo_state"
+    blocks_by_typename = _index_by_typename(book_info)
+
+    contributor = _take_largest_element(blocks_by_typename, "Contributor")
+    series = _take_first_element(blocks_by_typename, "Series")
+    work = _take_largest_element(blocks_by_typename, "Work")
+    book = _take_largest_element(blocks_by_typename, "Book")
+
+    if not book:
+        return None, "missing_book"
+    if not work or not work.get("stats"):
+        return None, "missing_work_stats"
+
+    loader = BookLoader(BookItem())
+    loader.add_value('url', url)
+    loader.add_value('title', book.get("title"))
+    loader.add_value('author', contributor.get("name"))
+    loader.add_value('author_url', contributor.get("webUrl"))
+    loader.add_value('num_ratings', work.get("stats").get("ratingsCount"))
+    loader.add_value('num_reviews', work.get("stats").get("textReviewsCount"))
+    loader.add_value('avg_rating', work.get("stats").get("averageRating"))
+    loader.add_value('num_pages', book.get("details").get("numPages"))
+    loader.add_value('language', book.get("details").get("language").get("name"))
+    loader.add_value('publish_date', book.get("details").get("publicationTime"))
+    loader.add_value('isbn', book.get("details").get("isbn"))
+    loader.add_value('isbn13', book.get("details").get("isbn13"))
+    loader.add_value('asin', book.get("details").get("asin"))
+    loader.add_value('series', series.get("title") if series else "")
+    loader.add_value('genres', _parse_genres(book.get("bookGenres")))
+    loader.add_value('rating_histogram', work.get("stats").get("ratingsCountDist"))
+
+    return loader.load_item(), None
+
+
+def _index_by_typename(input_dict):
+    """Group the apolloState blocks by their __typename in a single pass, keeping their original order"""
+    blocks_by_typename = defaultdict(list)
+    for block in input_dict.values():
+        blocks_by_typename[block.get(TYPENAME, "")].append(block)
+    return blocks_by_typename
+
+
+def _take_largest_element(blocks_by_typename, element_type):
+    blocks = blocks_by_typename.get(element_type)
+    if not blocks:
+        return None
+    if len(blocks) == 1:
+        return blocks[0]
+    # max() sizes every block exactly once and keeps the first of equally sized blocks
+    return max(blocks, key=_count_keys_recursive)
+
+
+def _take_first_element(blocks_by_typename, element_type):
+    blocks = blocks_by_typename.get(element_type)
+    return blocks[0] if blocks else None
+
+
+def _parse_genres(genre_input_list):
+    parsed_genres = []
+    for genre in genre_input_list:
+        if genre.get(TYPENAME) == "BookGenre":
+            genre_dict = genre.get("genre")
+            if genre_dict.get(TYPENAME) == "Genre":
+                parsed_genres.append(genre_dict.get("name"))
+    return parsed_genres
+
+
+def _count_keys_recursive(input_dict, counter=0):
+    for each_key in input_dict:
+        if isinstance(input_dict[each_key], dict):
+            # Recursive call
+            counter = _count_keys_recursive(input_dict[each_key], counter + 1)
+        else:
+            counter += 1
+    return counter
 
 
 class BookSpider(scrapy.Spider):
     """Extract information from a /book/show type page on Goodreads"""
     name = "book"
+    soft_retry_times = 3
+    soft_retry_backoff = 2.0
+    soft_retry_legacy_fallback = True
+    parse_pool = None
 
     def __init__(self, books="/book/show/12232938-the-lovely-bones"):
         super().__init__()
         self.start_urls = books.split(",")
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.soft_retry_times = crawler.settings.getint("BOOK_SOFT_RETRY_TIMES", cls.soft_retry_times)
+        spider.soft_retry_backoff = crawler.settings.getfloat("BOOK_SOFT_RETRY_BACKOFF", cls.soft_retry_backoff)
+        spider.soft_retry_legacy_fallback = crawler.settings.getbool("BOOK_SOFT_RETRY_LEGACY_FALLBACK",
+                                                                     cls.soft_retry_legacy_fallback)
+        spider.parse_pool = ParsePool.from_crawler(crawler)
+        return spider
+
     def start_requests(self):
         for url in self.start_urls:
             converted_url = self._format_book_url(url)
             yield Request(converted_url, callback=self.parse, dont_filter=True)
 
     def parse(self, response):
-        if response.selector.attrib.get('class', "").startswith("desktop withSiteHeaderTopFullImage"):
-            self.logger.info("Legacy response")
-            return self.parse_legacy_book(response)
-        else:
-            self.logger.info("New Book Response")
-            return self.parse_book(response)
-
-    def parse_book(self, response):
-        loader = BookLoader(BookItem(), response=response)
-
-        text_body = response.xpath('//*[@id="__NEXT_DATA__"]/text()').get()
-        parsed_json_body = json.loads(text_body)
-        book_info = parsed_json_body['props']['pageProps']['apolloState']
-
-        contributor = self._take_largest_element(book_info, "Contributor")
-        series = self._take_first_element(book_info, "Series")
-        work = self._take_largest_element(book_info, "Work")
-        book = self._take_largest_element(book_info, "Book")
-
         url = urlsplit(response.request.url).path
-
-        if not book:
-            self.logger.warning("Unable to load body, reloading page!")
-            converted_url = self._format_book_url(url)
-            return Request(converted_url, callback=self.parse, dont_filter=True)
-
-        loader.add_value('url', url)
-        loader.add_value('title', book.get("title"))
-        loader.add_value('author', contributor.get("name"))
-        loader.add_value('author_url', contributor.get("webUrl"))
-        loader.add_value('num_ratings', work.get("stats").get("ratingsCount"))
-        loader.add_value('num_reviews', work.get("stats").get("textReviewsCount"))
-        loader.add_value('avg_rating', work.get("stats").get("averageRating"))
-        loader.add_value('num_pages', book.get("details").get("numPages"))
-        loader.add_value('language', book.get("details").get("language").get("name"))
-        loader.add_value('publish_date', book.get("details").get("publicationTime"))
-        loader.add_value('isbn', book.get("details").get("isbn"))
-        loader.add_value('isbn13', book.get("details").get("isbn13"))
-        loader.add_value('asin', book.get("details").get("asin"))
-        loader.add_value('series', series.get("title") if series else "")
-        loader.add_value('genres', self._parse_genres(book.get("bookGenres")))
-        loader.add_value('rating_histogram', work.get("stats").get("ratingsCountDist"))
-
-        return loader.load_item()
+        if self.parse_pool is not None:
+            d = self.parse_pool.submit_response(parse_book_page, response, url, self.soft_retry_legacy_fallback)
+            return d.addCallback(self.book_parsed, response)
+        return self.book_parsed(parse_book_page(response, url, self.soft_retry_legacy_fallback), response)
 
     def parse_legacy_book(self, response):
-        loader = BookLoader(LegacyBookItem(), response=response)
-
-        # I use relative paths because that's what's in the reviews
-        loader.add_value('url', urlsplit(response.request.url).path)
-
-        loader.add_css("title", "#bookTitle::text")
-        loader.add_css("author", "a.authorName>span::text")
-        loader.add_css("author_url", 'a.authorName::attr(href)')
-
-        loader.add_css("num_ratings", "[itemprop=ratingCount]::attr(content)")
-        loader.add_css("num_reviews", "[itemprop=reviewCount]::attr(content)")
-        loader.add_css("avg_rating", "span[itemprop=ratingValue]::text")
-        loader.add_css("num_pages", "span[itemprop=numberOfPages]::text")
-
-        loader.add_css("language", "div[itemprop=inLanguage]::text")
-        loader.add_css('publish_date', 'div.row::text')
-        loader.add_css('publish_date', 'nobr.greyText::text')
-
-        loader.add_css("genres", 'div.left>a.bookPageGenreLink[href*="/genres/"]::text')
-        loader.add_css('series', 'div.infoBoxRowItem>a[href*="/series/"]::text')
-
-        loader.add_css('asin', 'div.infoBoxRowItem[itemprop=isbn]::text')
-        loader.add_css('asin', 'script::text', re=SIMILAR_EDITIONS_ASIN_REGEX)
-        loader.add_css('isbn', 'div.infoBoxRowItem[itemprop=isbn]::text')
-        loader.add_css('isbn', 'span[itemprop=isbn]::text')
-        loader.add_css('isbn', 'div.infoBoxRowItem::text')
-        loader.add_css('isbn', 'div.infoBoxRowItem::text')
-        loader.add_css('isbn', 'script::text', re=SIMILAR_EDITIONS_ISBN_REGEX)
-        loader.add_css('isbn13', 'div.infoBoxRowItem[itemprop=isbn]::text')
-        loader.add_css('isbn13', 'span[itemprop=isbn]::text')
-        loader.add_css('isbn13', 'div.infoBoxRowItem::text')
-        loader.add_css('isbn13', 'script::text', re=SIMILAR_EDITIONS_ISBN_13_REGEX)
-
-        loader.add_css('rating_histogram', 'script[type*="protovis"]::text')
-
-        return loader.load_item()
-
-    def _take_largest_element(self, input_dict, element_type):
-        largest = None
-        for block in input_dict.values():
-            if block.get(TYPENAME, "") == element_type:
-                if largest is None:
-                    largest = block
-                else:
-                    key_count = self._count_keys_recursive(block)
-                    largest_count = self._count_keys_recursive(largest)
-                    if key_count > largest_count:
-                        largest = block
-            else:
-                continue
-        return largest
-
-    def _parse_genres(self, genre_input_list):
-        parsed_genres = []
-        for genre in genre_input_list:
-            if genre.get(TYPENAME) == "BookGenre":
-                genre_dict = genre.get("genre")
-                if genre_dict.get(TYPENAME) == "Genre":
-                    parsed_genres.append(genre_dict.get("name"))
-        return parsed_genres
-
-    def _take_first_element(self, input_dict, element_type):
-        for block in input_dict.values():
-            if block.get(TYPENAME, "") == element_type:
-                return block
-
-    def _count_keys_recursive(self, input_dict, counter=0):
-        for each_key in input_dict:
-            if isinstance(input_dict[each_key], dict):
-                # Recursive call
-                counter = self._count_keys_recursive(input_dict[each_key], counter + 1)
-            else:
-                counter += 1
-        return counter
+        return parse_legacy_book_page(response, urlsplit(response.request.url).path)
+
+    def book_parsed(self, parsed, response):
+        item, reason = parsed
+        if reason is None:
+            self.logger.info("Legacy response" if isinstance(item, LegacyBookItem) else "New Book Response")
+            return item
+        if item is not None:
+            self.logger.info(f"Falling back to the legacy selectors ({reason}) for {response.url}")
+            self._inc_stat(f"book/soft_retry/legacy_fallback/{reason}")
+            return item
+        return self.soft_retry(response, reason)
+
+    def soft_retry(self, response, reason):
+        """Reload a page that came back without the data we need, which usually goes away after reloading it
+
+        Every URL gets `soft_retry_times` reloads, each after twice the delay of the previous one. Pages that still
+        carry the legacy markup never get here if `soft_retry_legacy_fallback` is set, parse_book_page falls back to
+        the legacy selectors for those.
+        """
+        retries = response.meta.get("soft_retries", 0)
+        if retries >= self.soft_retry_times:
+            self.logger.warning(f"Giving up on {response.url} after {retries} reloads ({reason})")
+            self._inc_stat(f"book/soft_retry/gave_up/{reason}")
+            return None
+
+        delay = self.soft_retry_backoff * 2 ** retries
+        self.logger.warning(f"Unable to load body ({reason}), reloading page in {delay:.0f}s!")
+        self._inc_stat(f"book/soft_retry/{reason}")
+        converted_url = self._format_book_url(urlsplit(response.request.url).path)
+        # Don't let the HTTP cache hand us the same broken page again. The DeferringScheduler holds the request until
+        # not_before, a middleware sleeping on it would take up a download slot for the whole delay
+        return Request(converted_url, callback=self.parse, dont_filter=True,
+                       meta={"dont_cache": True, "soft_retries": retries + 1, "not_before": time.time() + delay})
+
+    def _inc_stat(self, key):
+        # Spiders created by other spiders, like the ListSpider, may not have a crawler
+        crawler = getattr(self, "crawler", None)
+        if crawler is not None:
+            crawler.stats.inc_value(key, spider=self)
 
     @staticmethod
     def _format_book_url(user_id_and_name):
@@ -24,6 +24,13 @@ class ListSpider(scrapy.Spider):
             list_url = self.goodreads_list_url.format(list_name, page_no)
             self.start_urls.append(list_url)
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        # Gives the book spider the crawler's settings and stats
+        spider.book_spider = BookSpider.from_crawler(crawler)
+        return spider
+
     def parse(self, response):
         list_of_books = response.css("a.bookTitle::attr(href)").extract()
 
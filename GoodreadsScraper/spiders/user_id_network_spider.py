@@ -16,9 +16,22 @@ GOODREADS_URL_PREFIX = "https://www.goodreads.com"
 
 
 class UserIdNetworkSpider(scrapy.Spider):
+    """Walk the friend network starting from a profile, emitting every profile found along the way
+
+    Seen profiles are tracked in a fixed size Bloom filter keyed on user ID. Run it with a JOBDIR to spill the pending
+    requests to disk and persist the filter, which keeps memory flat and lets a stopped crawl resume. The frontier and
+    the filter are checkpointed together every SCHEDULER_CHECKPOINT_SECS, so that goes for a killed crawl as well:
+
+        scrapy crawl user_id_network -s JOBDIR=crawls/user_id_network
+    """
     name = "user_id_network"
     custom_settings = {'CLOSESPIDER_ITEMCOUNT': 100_000,
-                       'ITEM_PIPELINES': {'GoodreadsScraper.pipelines.GcpTaskQueuePipeline': 400}}
+                       'ITEM_PIPELINES': {'GoodreadsScraper.pipelines.GcpTaskQueuePipeline': 400},
+                       'DUPEFILTER_CLASS': 'GoodreadsScraper.dupefilters.UserIdBloomDupeFilter',
+                       # Breadth first, so the on disk frontier is worked through in the order it was found, and
+                       # checkpointed by the DeferringScheduler
+                       'SCHEDULER_DISK_QUEUE': 'GoodreadsScraper.squeues.PickleFifoCheckpointDiskQueue',
+                       'SCHEDULER_MEMORY_QUEUE': 'scrapy.squeues.FifoMemoryQueue'}
     start_urls = [
         'https://www.goodreads.com/user/show/24697113-david-fennessey',
     ]
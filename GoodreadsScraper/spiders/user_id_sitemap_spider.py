@@ -4,11 +4,10 @@ import logging
 import scrapy
 from scrapy import Request
 from scrapy.http import XmlResponse
-from scrapy.spiders.sitemap import iterloc
-from scrapy.utils.gz import gzip_magic_number, gunzip
-from scrapy.utils.sitemap import Sitemap
+from scrapy.utils.gz import gzip_magic_number
 
 from GoodreadsScraper.items import UserProfileItem
+from GoodreadsScraper.sitemap import iter_sitemap_locs
 
 logger = logging.getLogger(__name__)
 
@@ -20,31 +19,31 @@ class UserIdSitemapSpider(scrapy.Spider):
     )
 
     def parse(self, response):
-        body = self._get_sitemap_body(response)
-        sitemap = Sitemap(body)
-        if sitemap.type == 'sitemapindex':
-            for loc in iterloc(sitemap, False):
-                yield Request(loc, callback=self.parse)
-        else:
-            for site_link in sitemap:
-                url = site_link['loc']
-                if url.startswith("https://www.goodreads.com/user/show/"):
-                    yield self.parse_user_profile(url)
-                else:
-                    pass
+        sitemap_body = self._get_sitemap_body(response)
+        if sitemap_body is None:
+            logger.warning(f"Ignoring non-sitemap response {response.url}")
+            return
+
+        body, gzipped = sitemap_body
+        # Shards are parsed incrementally, so profiles are yielded while the rest of the shard is still compressed
+        for sitemap_type, url in iter_sitemap_locs(body, gzipped):
+            if sitemap_type == 'sitemapindex':
+                yield Request(url, callback=self.parse)
+            elif url.startswith("https://www.goodreads.com/user/show/"):
+                yield self.parse_user_profile(url)
 
     @staticmethod
     def parse_user_profile(url):
         return UserProfileItem({"profile_url": url})
 
     def _get_sitemap_body(self, response):
-        """Return the sitemap body contained in the given response,
+        """Return a (body, gzipped) tuple for the sitemap contained in the given response,
         or None if the response is not a sitemap.
         """
         if isinstance(response, XmlResponse):
-            return response.body
+            return response.body, False
         elif gzip_magic_number(response):
-            return gunzip(response.body)
+            return response.body, True
         # actual gzipped sitemap files are decompressed above ;
         # if we are here (response body is not gzipped)
         # and have a response for .xml.gz,
@@ -55,14 +54,4 @@ class UserIdSitemapSpider(scrapy.Spider):
         # merely XML gzip-compressed on the fly,
         # in other word, here, we have plain XML
         elif response.url.endswith('.xml') or response.url.endswith('.xml.gz'):
-            return response.body
-
-
-def iterloc(iterable, alt=False):
-    for d in iterable:
-        yield d['loc']
-
-        # Also consider alternate URLs (xhtml:link rel="alternate")
-        if alt and 'alternate' in d:
-            for l in d['alternate']:
-                yield l
+            return response.body, False
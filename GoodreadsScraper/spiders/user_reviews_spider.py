@@ -1,11 +1,15 @@
-"""Spider to extract information from a /author/show page"""
+"""Spider to extract the rated books of users from their /review/list pages"""
 import logging
+import math
 import re
 
 import scrapy
+from lxml import etree
 from scrapy import Request
 
+from ..extractors import RowExtractor, Rule
 from ..items import UserReviewLoader, UserReviewItem
+from ..parse_pool import ParsePool
 
 logger = logging.getLogger(__name__)
 USER_ID_NAME_EXTRACTOR = re.compile(".*/user/show/(.*$)")
@@ -13,69 +17,177 @@ USER_ID_EXTRACTOR = re.compile(".*review/list/(.*)\?")
 # For whatever reason, goodreads refuses to give scrapy more than 30 results per page to scrapers
 ITEMS_PER_PAGE = 30
 
+REVIEW_ROWS = etree.XPath('//tr[@class="bookalike review"]')
+# "30 of 1523 loaded" below the table, and "Read (1523)" in the shelf list as a fallback
+INFINITE_STATUS = etree.XPath('//div[@id="infiniteStatus"]/text()')
+SELECTED_SHELF = etree.XPath('//a[contains(concat(" ", normalize-space(@class), " "), " selectedShelf ")]/text()')
+INFINITE_STATUS_TOTAL_EXTRACTOR = re.compile(r"of\s+([\d,]+)\s+loaded")
+SHELF_TOTAL_EXTRACTOR = re.compile(r"\(([\d,]+)\)")
+REVIEW_ROW_EXTRACTOR = RowExtractor(UserReviewItem, UserReviewLoader, [
+    Rule('user_id'),
+    Rule('user_id_slug'),
+
+    Rule('book_link', cell="field title", xpath='.//a/@href'),
+    Rule('book_name', cell="field title", xpath='.//a/@title'),
+
+    Rule('author_link', cell="field author", xpath='.//a/@href'),
+    Rule('author_name', cell="field author", xpath='.//a/text()'),
+
+    Rule('date_read', cell="field date_read", xpath='.//div[@class="value"]//div//div//span/text()'),
+    Rule('date_added', cell="field date_added", xpath='.//div[@class="value"]//span/@title'),
+
+    # Collected as the Goodreads rating text, parse() replaces it with the star count
+    Rule('user_rating', cell="field rating",
+         xpath='.//div[@class="value"]//span[@class=" staticStars notranslate"]/@title'),
+])
+
+RATINGS = {
+    "it was amazing": 5,
+    "really liked it": 4,
+    "liked it": 3,
+    "it was ok": 2,
+    "did not like it": 1,
+}
+
+
+def parse_review_page(response, user_id, with_last_page=False):
+    """Extract the rated reviews of a review list page, as a (reviews, rated_reviews, last_page) tuple
+
+    `reviews` holds a (book link, UserReviewItem) tuple for each rated row in page order, and `last_page` is only looked
+    up `with_last_page`. This only depends on the response, so it can run in a ParsePool worker.
+    """
+    root = response.selector.root
+    reviews = []
+    for review_row in REVIEW_ROWS(root)[:ITEMS_PER_PAGE]:
+        collected = REVIEW_ROW_EXTRACTOR.collect(review_row)
+        goodreads_rating = REVIEW_ROW_EXTRACTOR.first(collected, 'user_rating')
+        user_rating = convert_goodreads_ratings_to_star_count(goodreads_rating)
+        if goodreads_rating and user_rating > 0:
+            reviews.append((REVIEW_ROW_EXTRACTOR.first(collected, 'book_link'),
+                            build_review(collected, user_id, user_rating)))
+    return reviews, len(reviews), extract_last_page(root) if with_last_page else None
+
+
+def extract_last_page(root):
+    for texts, extractor in ((INFINITE_STATUS(root), INFINITE_STATUS_TOTAL_EXTRACTOR),
+                             (SELECTED_SHELF(root), SHELF_TOTAL_EXTRACTOR)):
+        for text in texts:
+            match = extractor.search(text)
+            if match:
+                return max(1, math.ceil(int(match.group(1).replace(",", "")) / ITEMS_PER_PAGE))
+    return None
+
+
+def convert_goodreads_ratings_to_star_count(goodreads_rating):
+    return RATINGS.get(goodreads_rating)
+
+
+def build_review(collected, user_id, user_rating):
+    return REVIEW_ROW_EXTRACTOR.load(collected, user_id=user_id.split('-')[0], user_id_slug=user_id,
+                                     user_rating=user_rating)
+
 
 class UserReviewsSpider(scrapy.Spider):
+    """Scrape the rated books on the read shelf of each profile
+
+    The shelf is sorted by rating, so pages are only fetched until one comes back with less than a full page of rated
+    books. Once the first page tells us how many books the shelf has, up to `page_concurrency` pages of a profile are
+    in flight at once: every page that comes back full of rated books requests the page `page_concurrency` further on.
+    """
     name = "user_reviews"
+    page_concurrency = 4
+    parse_pool = None
 
-    def __init__(self, profiles):
+    def __init__(self, profiles, page_concurrency=None):
         super().__init__()
         self.start_urls = profiles.split(",")
+        if page_concurrency is not None:
+            # Paging only carries on from pages that are in flight, with none of them it would stop after page 1
+            self.page_concurrency = int(page_concurrency)
+            if self.page_concurrency < 1:
+                raise ValueError(f"page_concurrency must be at least 1, got {page_concurrency!r}")
+        # Book links already yielded and pages still outstanding per profile
+        self.seen_book_links = {}
+        self.pending_pages = {}
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        kwargs.setdefault("page_concurrency",
+                          crawler.settings.getint("USER_REVIEWS_PAGE_CONCURRENCY", cls.page_concurrency))
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.parse_pool = ParsePool.from_crawler(crawler)
+        return spider
 
     def start_requests(self):
         for url in self.start_urls:
             user_id = self.extract_username_from_url(url)
-            converted_url = self.format_review_url(user_id, 1)
-            yield Request(converted_url, callback=self.parse, dont_filter=True, meta={"user_id": user_id, "page": 1})
+            yield self.page_request(user_id, 1)
 
     def parse(self, response):
         user_id = response.meta.get("user_id")
-        review_blocks = response.xpath('//tr[@class="bookalike review"]')
-
-        reviews_yielded = 0
-        # When you scrape goodreads for whatever reason they put on infinite scroll, which causes them to return
-        # unpredictable numbers of reviews, and might cause problems when you paginate
-        for review_block in review_blocks[:ITEMS_PER_PAGE]:
-            goodreads_rating = review_block.xpath(
-                'td[@class="field rating"]//div[@class="value"]//span[@class=" staticStars notranslate"]/@title').get()
-            user_rating = self.convert_goodreads_ratings_to_star_count(goodreads_rating)
-            if goodreads_rating and user_rating > 0:
-                reviews_yielded += 1
-                yield self.build_review(review_block, user_id, user_rating)
-
-        if reviews_yielded == ITEMS_PER_PAGE:
-            new_page_count = response.meta.get("page") + 1
-            formatted_url = self.format_review_url(user_id, new_page_count)
-            yield Request(formatted_url, callback=self.parse, dont_filter=True,
-                          meta={"user_id": user_id, "page": new_page_count})
-
-    @staticmethod
-    def convert_goodreads_ratings_to_star_count(goodreads_rating):
-        ratings_dict = {
-            "it was amazing": 5,
-            "really liked it": 4,
-            "liked it": 3,
-            "it was ok": 2,
-            "did not like it": 1,
-        }
-        return ratings_dict.get(goodreads_rating)
+        page = response.meta.get("page")
+        if self.parse_pool is not None:
+            d = self.parse_pool.submit_response(parse_review_page, response, user_id, page == 1)
+            return d.addCallback(lambda parsed: list(self.page_parsed(response, *parsed)))
+        return self.page_parsed(response, *parse_review_page(response, user_id, page == 1))
 
-    @staticmethod
-    def build_review(review_block, user_id, user_rating):
-        loader = UserReviewLoader(UserReviewItem(), review_block)
-        loader.add_value('user_id', user_id.split('-')[0])
-        loader.add_value('user_id_slug', user_id)
-
-        loader.add_xpath('book_link', 'td[@class="field title"]//a/@href')
-        loader.add_xpath('book_name', 'td[@class="field title"]//a/@title')
-
-        loader.add_xpath('author_link', 'td[@class="field author"]//a/@href')
-        loader.add_xpath('author_name', 'td[@class="field author"]//a/text()')
-
-        loader.add_xpath('date_read', 'td[@class="field date_read"]//div[@class="value"]//div//div//span/text()')
-        loader.add_xpath('date_added', 'td[@class="field date_added"]//div[@class="value"]//span/@title')
+    def page_parsed(self, response, reviews, rated_reviews, last_page):
+        user_id = response.meta.get("user_id")
+        page = response.meta.get("page")
+        seen_book_links = self.seen_book_links.setdefault(user_id, set())
 
-        loader.add_value('user_rating', user_rating)
-        return loader.load_item()
+        # When you scrape goodreads for whatever reason they put on infinite scroll, which causes them to return
+        # unpredictable numbers of reviews, and might cause problems when you paginate. The same book can then show up
+        # at the end of one page and the start of the next, so books are only yielded once per profile.
+        for book_link, review in reviews:
+            if book_link not in seen_book_links:
+                seen_book_links.add(book_link)
+                yield review
+
+        if page == 1:
+            response.meta["last_page"] = last_page
+            if rated_reviews == ITEMS_PER_PAGE and last_page is not None:
+                # Open the window, every page in it keeps it moving by requesting its successor below
+                for next_page in range(2, min(1 + self.page_concurrency, last_page) + 1):
+                    yield self.page_request(user_id, next_page, last_page)
+                self._page_done(user_id)
+                return
+
+        if rated_reviews == ITEMS_PER_PAGE:
+            yield from self._next_page_requests(response)
+        self._page_done(user_id)
+
+    def page_failed(self, failure):
+        # Keep the window moving, otherwise every page after this one in its stride would be lost
+        meta = failure.request.meta
+        self.logger.warning(f"Failed to fetch page {meta['page']} of {meta['user_id']}: {failure.getErrorMessage()}")
+        yield from self._next_page_requests(failure.request)
+        self._page_done(meta["user_id"])
+
+    def page_request(self, user_id, page, last_page=None):
+        self.pending_pages[user_id] = self.pending_pages.get(user_id, 0) + 1
+        return Request(self.format_review_url(user_id, page), callback=self.parse, errback=self.page_failed,
+                       dont_filter=True, meta={"user_id": user_id, "page": page, "last_page": last_page})
+
+    def _next_page_requests(self, response):
+        user_id, page, last_page = response.meta["user_id"], response.meta["page"], response.meta.get("last_page")
+        if last_page is None:
+            # The shelf size is unknown, fall back to fetching one page after the other
+            yield self.page_request(user_id, page + 1)
+        elif page + self.page_concurrency <= last_page:
+            yield self.page_request(user_id, page + self.page_concurrency, last_page)
+
+    def _page_done(self, user_id):
+        self.pending_pages[user_id] = self.pending_pages.get(user_id, 1) - 1
+        if self.pending_pages[user_id] <= 0:
+            # The profile is finished, forget its books
+            self.pending_pages.pop(user_id, None)
+            self.seen_book_links.pop(user_id, None)
+
+    # The page parsing lives in module level functions, so that ParsePool workers can run it
+    extract_last_page = staticmethod(extract_last_page)
+    convert_goodreads_ratings_to_star_count = staticmethod(convert_goodreads_ratings_to_star_count)
+    build_review = staticmethod(build_review)
 
     @staticmethod
     def format_review_url(user_id_and_name, page):
@@ -0,0 +1,101 @@
+"""Disk queues whose state can be saved while the crawl runs
+
+queuelib's FifoDiskQueue only records where its data starts and ends when it is closed, and deletes chunks as soon as
+they are read, so a crawl that gets killed can't get back its frontier. CheckpointFifoDiskQueue reports that state at
+any time, keeps everything a saved state may still point to, and can be put back into a saved state, which is what the
+DeferringScheduler checkpoints a JOBDIR with.
+"""
+import json
+import os
+import pickle
+import re
+import shutil
+import struct
+
+from queuelib import queue
+from scrapy.squeues import _pickle_serialize, _scrapy_serialization_queue, _serializable_queue, _with_mkdir
+
+CHUNK_NAME = re.compile(r"^q(\d{5})$")
+
+
+class CheckpointFifoDiskQueue(queue.FifoDiskQueue):
+    """FifoDiskQueue that can be restored to any state snapshot() returned
+
+    Chunks that were read to the end are only deleted by discard_consumed(), and an empty queue keeps its files when
+    it is closed.
+    """
+
+    def pop(self):
+        # FifoDiskQueue.pop, except that a chunk read to the end is kept
+        tnum, tcnt, toffset = self.info['tail']
+        if [tnum, tcnt] >= self.info['head']:
+            return None
+        tfd = self.tailf.fileno()
+        szhdr = os.read(tfd, self.szhdr_size)
+        if not szhdr:
+            return None
+        size, = struct.unpack(self.szhdr_format, szhdr)
+        data = os.read(tfd, size)
+        tcnt += 1
+        toffset += self.szhdr_size + size
+        if tcnt == self.chunksize and tnum <= self.info['head'][0]:
+            tcnt = toffset = 0
+            tnum += 1
+            self.tailf.close()
+            self.tailf = self._openchunk(tnum)
+        self.info['size'] -= 1
+        self.info['tail'] = [tnum, tcnt, toffset]
+        return data
+
+    def close(self):
+        self.headf.close()
+        self.tailf.close()
+        self._saveinfo(self.info)
+
+    def snapshot(self):
+        # Pushes only ever append to the head chunk, so its size marks the end of the data in this state
+        return dict(self.info, head_offset=os.fstat(self.headf.fileno()).st_size)
+
+    @classmethod
+    def restore(cls, path, state):
+        """Put the queue files at `path` back into `state`, dropping whatever was pushed after it was taken"""
+        os.makedirs(path, exist_ok=True)
+        head_chunk, tail_chunk = state['head'][0], state['tail'][0]
+        for number, chunk_path in cls._chunks(path):
+            if number < tail_chunk or number > head_chunk:
+                os.remove(chunk_path)
+            elif number == head_chunk:
+                os.truncate(chunk_path, state['head_offset'])
+        with open(os.path.join(path, 'info.json'), 'w') as f:
+            json.dump(state, f)
+
+    @classmethod
+    def discard_consumed(cls, path, state):
+        """Delete the chunks that were read to the end before `state` was taken"""
+        for number, chunk_path in cls._chunks(path):
+            if number < state['tail'][0]:
+                os.remove(chunk_path)
+
+    @staticmethod
+    def _chunks(path):
+        if not os.path.isdir(path):
+            return []
+        chunks = []
+        for name in os.listdir(path):
+            match = CHUNK_NAME.match(name)
+            if match:
+                chunks.append((int(match.group(1)), os.path.join(path, name)))
+        return chunks
+
+
+def remove_queues(dqdir, keep):
+    """Delete the queue directories in `dqdir` other than the ones named in `keep`"""
+    for name in os.listdir(dqdir):
+        path = os.path.join(dqdir, name)
+        if os.path.isdir(path) and name not in keep:
+            shutil.rmtree(path)
+
+
+PickleFifoCheckpointDiskQueue = _scrapy_serialization_queue(
+    _serializable_queue(_with_mkdir(CheckpointFifoDiskQueue), _pickle_serialize, pickle.loads)
+)
@@ -1,67 +1,203 @@
+"""Enqueue books to be scraped by the /scrape-books endpoint as Cloud Tasks
+
+The input is streamed rather than loaded, so exports with millions of rows are fine. It can be JSON lines (like the
+output of recrawl_scheduler.py), CSV or plain text with one link per line. Links are deduplicated on the fly by their
+Goodreads book ID, grouped into tasks of --books-per-task links and submitted by --concurrency threads at no more than
+--rate tasks per second.
+
+Progress is checkpointed as the number of leading tasks that have been submitted. Running the same command again after
+an interruption skips those and carries on. Tasks submitted out of order just before the interruption may be enqueued
+twice.
+
+    python -m ad_hoc_scripts.book_enqueuer --book-file recrawl.jl --concurrency 16 --rate 50
+"""
 import argparse
+import csv
+import hashlib
+import itertools
 import json
 import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
 
-from google.cloud import tasks_v2
+from dao.cloud_tasks_dao import CloudTasksDao
 
 logger = logging.getLogger(__name__)
 
 NUMBER_OF_BOOKS_PER_CRAWL = 60
-
-
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+QUEUE_NAME = "profile-scrape-queue"
+HTTP_TARGET = "https://user-review-scraper-pool-tmzffqb3oq-ue.a.run.app/scrape-books"
+BOOK_ID_EXTRACTOR = re.compile(r"^/book/show/(\d+)")
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jl", ".jsonl", ".json"):
+        return "jsonl"
+    if extension == ".csv":
+        return "csv"
+    return "text"
+
+
+def iter_book_links(path, input_format, column="book_link"):
+    """Yield the book links in the input file one at a time"""
+    with open(path, newline="") as books:
+        if input_format == "csv":
+            for row in csv.DictReader(books):
+                yield row.get(column)
+        elif input_format == "jsonl":
+            for line in books:
+                if line.strip():
+                    yield json.loads(line).get(column)
+        else:
+            for line in books:
+                yield line.strip()
+
+
+def unique_book_links(links):
+    """Drop empty and already seen links, /book/show/1.Foo and /book/show/1-foo count as the same book
+
+    Links can be relative, like the ones in reviews and recrawl_scheduler.py output, or absolute.
+
+    Only an 8 byte digest is kept per book, which keeps tens of millions of links within a few GB.
+    """
+    seen = set()
+    for link in links:
+        if not link:
+            continue
+        match = BOOK_ID_EXTRACTOR.match(urlsplit(link).path)
+        key = match.group(1) if match else link
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+        if digest not in seen:
+            seen.add(digest)
+            yield link
+
+
+def chunks(iterable, n):
+    """Yield successive n-sized lists from iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+class RateLimiter(object):
+    """Spaces out calls to `wait` so that at most `rate` of them return per second across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+class Checkpoint(object):
+    """Number of leading tasks that have been submitted, persisted atomically next to the input"""
+
+    def __init__(self, path, input_file, books_per_task):
+        self.path = path
+        self.key = {"input_file": os.path.abspath(input_file), "books_per_task": books_per_task}
+        self.tasks_done = 0
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if {k: state.get(k) for k in self.key} != self.key:
+                raise ValueError(f"{path} is a checkpoint for a different input or --books-per-task, delete it first")
+            self.tasks_done = state["tasks_done"]
+
+    def save(self, tasks_done):
+        self.tasks_done = tasks_done
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump(dict(self.key, tasks_done=tasks_done), checkpoint_file)
+        os.replace(tmp_path, self.path)
 
 
 class BookScrapeEnqueuer(object):
 
-    def __init__(self, input_file):
-        self.pipeline_name = "profile-scrape-queue"
-        self.http_target = "https://user-review-scraper-pool-tmzffqb3oq-ue.a.run.app/scrape-books"
-        self.client = tasks_v2.CloudTasksClient()
-        self.parent = self.client.queue_path("book-suggestion-please", "us-east1", self.pipeline_name)
-        self.input_file = input_file
-
-    def enqueue_books(self):
-        items = []
-        with open(self.input_file) as books:
-            for line in books:
-                line_json = json.loads(line)
-                items.append(line_json.get("book_link"))
-
-        for chunk in chunks(items, NUMBER_OF_BOOKS_PER_CRAWL):
-            self.send_task(chunk)
-
-        print("Done!")
+    def __init__(self, dao, checkpoint, concurrency, rate, failed_output):
+        self.dao = dao
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rate)
+        self.failed_output = failed_output
+
+    def enqueue_books(self, book_links, books_per_task):
+        tasks = chunks(unique_book_links(book_links), books_per_task)
+        # Deduplication has to see the skipped links too, otherwise the remaining tasks would come out differently
+        tasks = itertools.islice(enumerate(tasks), self.checkpoint.tasks_done, None)
+        if self.checkpoint.tasks_done:
+            print(f"Resuming after {self.checkpoint.tasks_done} tasks")
+
+        completed = set()
+        watermark = self.checkpoint.tasks_done
+        in_flight = {}
+        failed = 0
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor, \
+                open(self.failed_output, "a") as failed_file:
+            for task_number, book_chunk in itertools.chain(tasks, [(None, None)]):
+                # Only keep a couple of tasks per thread around so the input is read no faster than it is submitted
+                while in_flight and (task_number is None or len(in_flight) >= 2 * self.concurrency):
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        done_number, done_chunk = in_flight.pop(future)
+                        if future.exception() is not None:
+                            logger.error(f"Giving up on task {done_number}: {future.exception()}")
+                            failed_file.writelines(json.dumps({"book_link": link}) + "\n" for link in done_chunk)
+                            failed += 1
+                        completed.add(done_number)
+                    while watermark in completed:
+                        completed.remove(watermark)
+                        watermark += 1
+                    self.checkpoint.save(watermark)
+                if task_number is None:
+                    break
+                in_flight[executor.submit(self.send_task, book_chunk)] = (task_number, book_chunk)
+
+        elapsed = time.monotonic() - started
+        print(f"Done! {watermark} tasks submitted in total, {failed} failed this run (see {self.failed_output}), "
+              f"took {elapsed:.0f}s")
 
     def send_task(self, book_chunk):
-        task = {
-            "http_request": {  # Specify the type of request.
-                "http_method": tasks_v2.HttpMethod.POST,
-                "url": self.http_target,  # The full url path that the task will be sent to.
-            }
-        }
-        if len(book_chunk) > 0:
-            payload = json.dumps({"book_urls": book_chunk})
-            # specify http content-type to application/json
-            task["http_request"]["headers"] = {"Content-type": "application/json"}
-
-            # The API expects a payload of type bytes.
-            converted_payload = payload.encode()
-
-            # Add the payload to the request.
-            task["http_request"]["body"] = converted_payload
-
-            response = self.client.create_task(request={"parent": self.parent, "task": task})
-            print("Created task {}".format(response.name))
+        self.rate_limiter.wait()
+        task_name = self.dao.create_task({"book_urls": book_chunk})
+        logger.info(f"Created task {task_name}")
+        return task_name
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Book loader')
-    parser.add_argument('--book-file', help='please give the file of JSON encoded books to load to be scraped')
+    parser.add_argument('--book-file', required=True,
+                        help='the JSON lines, CSV or text file (one link per line) of books to be scraped')
+    parser.add_argument('--format', choices=['jsonl', 'csv', 'text'],
+                        help='the format of --book-file, guessed from its extension by default')
+    parser.add_argument('--column', default='book_link', help='the JSON key or CSV column holding the book link')
+    parser.add_argument('--books-per-task', type=int, default=NUMBER_OF_BOOKS_PER_CRAWL)
+    parser.add_argument('--concurrency', type=int, default=8, help='number of tasks to create in parallel')
+    parser.add_argument('--rate', type=float, default=50, help='maximum tasks created per second, 0 for no limit')
+    parser.add_argument('--checkpoint', help='checkpoint file, defaults to <book-file>.checkpoint')
+    parser.add_argument('--failed-output', help='JSON lines file for the books of failed tasks, '
+                                                'defaults to <book-file>.failed.jl')
     args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
 
-    enqueuer = BookScrapeEnqueuer(args.book_file)
-    enqueuer.enqueue_books()
+    checkpoint = Checkpoint(args.checkpoint or args.book_file + ".checkpoint", args.book_file, args.books_per_task)
+    enqueuer = BookScrapeEnqueuer(CloudTasksDao(QUEUE_NAME, HTTP_TARGET), checkpoint, args.concurrency, args.rate,
+                                  args.failed_output or args.book_file + ".failed.jl")
+    book_links = iter_book_links(args.book_file, args.format or detect_format(args.book_file), args.column)
+    enqueuer.enqueue_books(book_links, args.books_per_task)
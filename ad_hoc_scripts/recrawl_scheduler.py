@@ -0,0 +1,87 @@
+"""Pick the books that are worth re-scraping today
+
+Most of the catalogue barely moves between scrapes, so instead of re-enqueueing whole book lists this looks at the
+recrawl state (see RecrawlStatePipeline) and only emits books that are expected to have picked up a meaningful number of
+ratings and reviews since they were last scraped. Those are ordered by staleness multiplied by popularity and cut off at
+the daily request budget. The output is JSON lines of {"book_link": ...}, which book_enqueuer.py takes as input.
+
+    python -m ad_hoc_scripts.recrawl_scheduler --import-items book_*.jl --budget 20000 --output recrawl.jl
+"""
+import argparse
+import heapq
+import json
+import logging
+import os
+from time import time
+
+from dao.recrawl_state_dao import RecrawlStateDao
+
+logger = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+# Share of its existing ratings a book is assumed to gain per day until we have two observations to go by
+DEFAULT_DAILY_CHANGE_RATE = 0.0005
+
+
+def expected_daily_change(book):
+    """Estimate how many ratings and reviews a book gains per day"""
+    if book["prev_scraped"] and book["last_scraped"] > book["prev_scraped"]:
+        days_between_scrapes = (book["last_scraped"] - book["prev_scraped"]) / SECONDS_PER_DAY
+        ratings_delta = max(0, (book["num_ratings"] or 0) - (book["prev_num_ratings"] or 0))
+        reviews_delta = max(0, (book["num_reviews"] or 0) - (book["prev_num_reviews"] or 0))
+        return (ratings_delta + reviews_delta) / days_between_scrapes
+    return ((book["num_ratings"] or 0) + (book["num_reviews"] or 0)) * DEFAULT_DAILY_CHANGE_RATE
+
+
+def schedule(books, budget, min_expected_change, now=None):
+    """Return the urls of at most `budget` books worth re-scraping, most urgent first"""
+    now = now if now is not None else time()
+    candidates = []
+    for book in books:
+        staleness_days = max(0.0, (now - book["last_scraped"]) / SECONDS_PER_DAY)
+        if expected_daily_change(book) * staleness_days < min_expected_change:
+            continue
+        popularity = (book["num_ratings"] or 0) + (book["num_reviews"] or 0) + 1
+        candidates.append((staleness_days * popularity, book["url"]))
+        # Keep memory bounded on large catalogues by only ever holding on to the best `budget` candidates
+        if len(candidates) > 2 * budget:
+            candidates = heapq.nlargest(budget, candidates)
+    return [url for _, url in heapq.nlargest(budget, candidates)]
+
+
+def import_items(dao, filenames):
+    """Fill the recrawl state from JSON lines book output, using the file modification time as the scrape time"""
+    imported = 0
+    for filename in filenames:
+        scraped_at = os.path.getmtime(filename)
+        with open(filename) as items:
+            for line in items:
+                item = json.loads(line)
+                if item.get("url"):
+                    dao.record(item["url"], item.get("num_ratings"), item.get("num_reviews"), scraped_at)
+                    imported += 1
+    dao.commit()
+    return imported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recrawl scheduler')
+    parser.add_argument('--state-db', default='recrawl_state.sqlite3', help='the recrawl state SQLite file')
+    parser.add_argument('--import-items', nargs='+', default=[],
+                        help='JSON lines files of scraped books to add to the state before scheduling')
+    parser.add_argument('--budget', type=int, default=10_000, help='maximum number of books to emit')
+    parser.add_argument('--min-expected-change', type=float, default=5.0,
+                        help='minimum number of new ratings and reviews a book must be expected to have')
+    parser.add_argument('--output', required=True, help='JSON lines file to write the books to scrape to')
+    args = parser.parse_args()
+
+    state = RecrawlStateDao(args.state_db)
+    if args.import_items:
+        print(f"Imported {import_items(state, args.import_items)} books")
+
+    scheduled = schedule(state.iter_books(), args.budget, args.min_expected_change)
+    with open(args.output, "w") as output:
+        for url in scheduled:
+            output.write(json.dumps({"book_link": url}) + "\n")
+    state.close()
+    print(f"Scheduled {len(scheduled)} books")
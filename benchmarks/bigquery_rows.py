@@ -0,0 +1,131 @@
+"""Check that models.bigquery_rows converts items into the same rows as the pydantic DTOs, and time both
+
+Every case is converted through the DTO (`parse_obj_as(dto_cls, item).dict()`, one item at a time like the web app
+used to) and through its RowConverter. Rows that differ, or items only one of them rejects, are printed and make the
+exit code 1. ingest_time is left out of the comparison, the DTOs fix it at import time.
+
+    python -m benchmarks.bigquery_rows --count 100000
+"""
+import argparse
+import sys
+import time
+
+from pydantic import ValidationError, parse_obj_as
+
+from models.bigquery_rows import BOOK_ROWS, USER_REVIEW_ROWS
+from models.books_bigquery_dto import BooksBigQueryDto
+from models.user_review_bigquery_dto import UserReviewBigQueryDto
+
+
+def book_values(count):
+    books = []
+    for i in range(count):
+        book = {
+            "url": f"/book/show/{i}-x", "title": "The Lovely Bones", "author": "Alice Sebold",
+            "author_url": "https://www.goodreads.com/author/show/4599.Alice_Sebold", "avg_rating": 3.84,
+            "genres": ["Fiction", "Fantasy", "Mystery"], "isbn": "0316666343", "isbn13": "9780316666343",
+            "asin": "B000SEIU28", "language": "English", "num_pages": 328, "num_ratings": 2163851,
+            "num_reviews": 48615, "publish_date": "2002-07-03 00:00:00", "series": "The Lovely Bones",
+            "rating_histogram": '{"5": 651811, "4": 811019, "3": 504122, "2": 138462, "1": 58437}',
+        }
+        # Legacy pages and incomplete books: missing optional fields, values as strings, and unusable items
+        variant = i % 10
+        if variant == 1:
+            for field in ("isbn", "isbn13", "asin", "series", "num_pages", "publish_date"):
+                del book[field]
+        elif variant == 2:
+            book.update(avg_rating="3.84", num_ratings="2163851", num_pages="328", genres=[])
+        elif variant == 3:
+            del book["rating_histogram"]
+        elif variant == 4:
+            book["avg_rating"] = None
+        elif variant == 5:
+            book["num_ratings"] = "many"
+        elif variant == 6:
+            book["book_title"] = book.pop("title")
+        books.append(book)
+    return books
+
+
+def review_values(count):
+    reviews = []
+    for i in range(count):
+        review = {
+            "user_id": str(i), "user_id_slug": f"{i}-reader",
+            "book_link": f"/book/show/{i}", "book_name": "A book",
+            "author_link": f"/author/show/{i}", "author_name": "An author",
+            "date_read": "2017-09-12 00:00:00", "date_added": "2017-09-12 00:00:00",
+            "user_rating": 5,
+        }
+        variant = i % 10
+        if variant == 1:
+            del review["date_read"]
+        elif variant == 2:
+            review["user_rating"] = "4"
+        elif variant == 3:
+            del review["user_rating"]
+        reviews.append(review)
+    return reviews
+
+
+CASES = [
+    ("book", book_values, BooksBigQueryDto, BOOK_ROWS),
+    ("user_review", review_values, UserReviewBigQueryDto, USER_REVIEW_ROWS),
+]
+
+
+def dto_rows(dto_cls, items):
+    rows, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            rows.append(parse_obj_as(dto_cls, item).dict())
+        except ValidationError as e:
+            errors.append((index, str(e)))
+    return rows, errors
+
+
+def without_ingest_time(rows):
+    return [{column: value for column, value in row.items() if column != "ingest_time"} for row in rows]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the BigQuery row converters against the pydantic DTOs')
+    parser.add_argument('--count', type=int, default=20000, help='Items converted per case')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    differences = 0
+    print(f"{'case':<12} {'rows':>8} {'rejected':>8} {'dto s':>8} {'rows s':>8} {'speedup':>8}")
+    print("-" * 57)
+    for name, make_values, dto_cls, converter in CASES:
+        items = make_values(args.count)
+
+        started = time.perf_counter()
+        expected, expected_errors = dto_rows(dto_cls, items)
+        dto_secs = time.perf_counter() - started
+
+        started = time.perf_counter()
+        rows, errors = converter.convert(items)
+        converter_secs = time.perf_counter() - started
+
+        rejected = [index for index, _ in errors]
+        if rejected != [index for index, _ in expected_errors]:
+            differences += 1
+            print(f"{name}: rejected items differ, {rejected[:10]} against {[i for i, _ in expected_errors][:10]}")
+        for row, expected_row in zip(without_ingest_time(rows), without_ingest_time(expected)):
+            if row != expected_row:
+                differences += 1
+                print(f"{name}: {row} != {expected_row}")
+                break
+        print(f"{name:<12} {len(rows):>8} {len(errors):>8} {dto_secs:>8.3f} {converter_secs:>8.3f} "
+              f"{dto_secs / converter_secs:>7.1f}x")
+
+    if differences:
+        sys.exit(1)
+    print("All rows identical")
+
+
+if __name__ == "__main__":
+    main()
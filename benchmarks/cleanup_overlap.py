@@ -0,0 +1,85 @@
+"""Check that cleanup.clean_files handles input files that overlap, like concatenated re-scrape dumps
+
+Each case cleans a few JSONLINES files of books that repeat each other's urls, with a chunk size small enough for
+whole chunks to consist of urls that were seen already. The CSV has to be identical to the one cleaned from a single
+file holding every distinct book once, and integer columns have to be written as integers in every chunk, whether
+or not the chunk is missing some of their values. Differences are printed and make the exit code 1.
+
+    python -m benchmarks.cleanup_overlap
+"""
+import csv
+import json
+import os
+import sys
+import tempfile
+
+from cleanup import clean_files
+
+INTEGER_COLUMNS = ["num_ratings", "num_pages", "publish_year", "publish_month", "publish_day"]
+GENRES = ["Fiction", "Fantasy", "Mystery", "Classics", "Romance", "Young Adult"]
+
+
+def book(i):
+    values = {
+        "url": f"/book/show/{i}-x", "title": f"Book {i}", "author": "An author", "num_ratings": i * 10,
+        "avg_rating": 3.5, "genres": GENRES[i % 3:i % 3 + 3] if i % 5 else None,
+        "publish_date": f"{2000 + i % 20}-07-03 00:00:00" if i % 17 else None,
+    }
+    # Only some books, and so only some chunks, miss a page count
+    if i % 13:
+        values["num_pages"] = 100 + i
+    return values
+
+
+def float_formatted(path):
+    """The (column, value) pairs of integer columns that were written as floats"""
+    with open(path, newline="") as f:
+        return [(column, row[column]) for row in csv.DictReader(f) for column in INTEGER_COLUMNS if "." in row[column]]
+
+
+CASES = [
+    ("identical files", [range(0, 40), range(0, 40)]),
+    ("overlapping files", [range(0, 40), range(20, 60), range(0, 60)]),
+    ("file repeated within", [list(range(0, 20)) * 3]),
+]
+
+
+def write_books(path, ids):
+    with open(path, "w") as f:
+        for i in ids:
+            f.write(json.dumps(book(i)) + "\n")
+
+
+def main():
+    differences = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for name, files in CASES:
+            filenames = []
+            for number, ids in enumerate(files):
+                filenames.append(os.path.join(directory, f"books_{number}.jl"))
+                write_books(filenames[-1], ids)
+            expected_ids = list(dict.fromkeys(i for ids in files for i in ids))
+            write_books(os.path.join(directory, "expected.jl"), expected_ids)
+
+            clean_files(filenames, os.path.join(directory, "actual.csv"), chunksize=10)
+            clean_files([os.path.join(directory, "expected.jl")], os.path.join(directory, "expected.csv"), chunksize=10)
+            with open(os.path.join(directory, "actual.csv")) as actual, \
+                    open(os.path.join(directory, "expected.csv")) as expected:
+                if actual.read() != expected.read():
+                    differences += 1
+                    print(f"{name}: the CSV differs from the one of the distinct books")
+                    continue
+            floats = float_formatted(os.path.join(directory, "actual.csv"))
+            if floats:
+                differences += 1
+                print(f"{name}: integer columns written as floats, e.g. {floats[:3]}")
+                continue
+            print(f"{name}: {len(expected_ids)} distinct books")
+
+    if differences:
+        sys.exit(1)
+    print("All cases identical")
+
+
+if __name__ == "__main__":
+    main()
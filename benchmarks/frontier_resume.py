@@ -0,0 +1,137 @@
+"""Check that a UserIdNetworkSpider crawl that gets killed resumes without losing part of the friend network
+
+Crawls a synthetic friend network, served by a fake download handler, with a JOBDIR. The crawl is killed with SIGKILL
+once it crawled a third of the profiles, and then run again with the same JOBDIR until it finishes. Every profile has
+to have been crawled by one of the two runs, or the missing ones are printed and the exit code is 1. Profiles crawled
+by both runs are what was crawled since the last checkpoint.
+
+    python -m benchmarks.frontier_resume --profiles 400
+"""
+import argparse
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from scrapy.crawler import CrawlerProcess
+from scrapy.http import HtmlResponse
+from scrapy.utils.project import get_project_settings
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+
+from GoodreadsScraper.spiders.user_id_network_spider import UserIdNetworkSpider
+
+ROOT_USER_ID = 24697113
+FRIENDS_PER_PROFILE = 5
+RESPONSE_SECS = 0.05
+
+
+def friend_ids(user_id, profiles):
+    """The friends of a profile: the next one, so that every profile can be reached, and a few random others"""
+    if user_id == ROOT_USER_ID:
+        return [1]
+    friends = random.Random(user_id).sample(range(1, profiles + 1), FRIENDS_PER_PROFILE - 1)
+    return [user_id % profiles + 1] + friends
+
+
+def profile_page(user_id, profiles):
+    blocks = "".join(f'<div class="left"><div class="friendName"><a href="/user/show/{friend}-reader">Reader</a>'
+                     f'</div>\n120 books\n</div>' for friend in friend_ids(user_id, profiles))
+    return f"<html><body>{blocks}</body></html>".encode()
+
+
+class FakeDownloadHandler(object):
+    """Serves the synthetic network, and appends the ID of every profile it serves to FRONTIER_RESUME_LOG"""
+    lazy = False
+
+    def __init__(self, profiles, log_path):
+        self.profiles = profiles
+        self.log = open(log_path, "a", buffering=1)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.getint('FRONTIER_RESUME_PROFILES'), crawler.settings['FRONTIER_RESUME_LOG'])
+
+    def download_request(self, request, spider):
+        user_id = int(request.url.split("/user/show/")[1].split("-")[0])
+        self.log.write(f"{user_id}\n")
+        return deferLater(reactor, RESPONSE_SECS, HtmlResponse, request.url, request=request,
+                          body=profile_page(user_id, self.profiles))
+
+
+def crawl(jobdir, log_path, profiles):
+    settings = get_project_settings()
+    for name, value in {
+        'JOBDIR': jobdir,
+        'DOWNLOAD_HANDLERS': {'https': f'{__name__}.FakeDownloadHandler'},
+        'FRONTIER_RESUME_PROFILES': profiles,
+        'FRONTIER_RESUME_LOG': log_path,
+        'ITEM_PIPELINES': {},
+        'CLOSESPIDER_ITEMCOUNT': 0,
+        'ROBOTSTXT_OBEY': False,
+        'HTTPCACHE_ENABLED': False,
+        'CONCURRENT_REQUESTS': 4,
+        'ENDPOINT_THROTTLE_RATES': {'user_profile': (100.0, 100.0)},
+        'SCHEDULER_CHECKPOINT_SECS': 0.5,
+        'LOG_LEVEL': 'WARNING',
+    }.items():
+        # Above the spider's custom_settings
+        settings.set(name, value, priority='cmdline')
+    process = CrawlerProcess(settings)
+    process.crawl(UserIdNetworkSpider)
+    process.start()
+
+
+def crawled(log_path):
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path) as f:
+        return [int(line) for line in f if line.strip()]
+
+
+def run_crawl(jobdir, log_path, profiles, kill_after=None):
+    command = [sys.executable, "-m", __spec__.name, "--profiles", str(profiles), "--crawl", jobdir, log_path]
+    child = subprocess.Popen(command)
+    if kill_after is None:
+        return child.wait()
+    while child.poll() is None and len(crawled(log_path)) < kill_after:
+        time.sleep(0.05)
+    child.send_signal(signal.SIGKILL)
+    return child.wait()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Kill a UserIdNetworkSpider crawl and check that it resumes')
+    parser.add_argument('--profiles', type=int, default=400, help='Profiles in the synthetic friend network')
+    parser.add_argument('--crawl', nargs=2, metavar=('JOBDIR', 'LOG'), help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.crawl:
+        crawl(*args.crawl, args.profiles)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        jobdir = os.path.join(directory, "job")
+        first_log, second_log = os.path.join(directory, "first.log"), os.path.join(directory, "second.log")
+        run_crawl(jobdir, first_log, args.profiles, kill_after=args.profiles // 3)
+        first = set(crawled(first_log)) - {ROOT_USER_ID}
+        run_crawl(jobdir, second_log, args.profiles)
+        second = set(crawled(second_log)) - {ROOT_USER_ID}
+
+    missing = sorted(set(range(1, args.profiles + 1)) - first - second)
+    print(f"killed run:  {len(first)} profiles")
+    print(f"resumed run: {len(second)} profiles, {len(first & second)} of them crawled again")
+    if missing:
+        print(f"{len(missing)} profiles were never crawled, e.g. {missing[:10]}")
+        sys.exit(1)
+    print(f"All {args.profiles} profiles crawled")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Memory used per item by the compact UserProfileItem and UserReviewItem, against the scrapy.Item versions they replaced
+
+The scrapy.Item definitions are kept here as the reference. Each case builds `--count` items of both kinds from the
+same, already allocated, field values, so only the item objects themselves are measured, using tracemalloc. That
+includes the trackref bookkeeping Scrapy keeps for every scrapy.Item.
+
+    python -m benchmarks.item_memory --count 1000000
+"""
+import argparse
+import gc
+import tracemalloc
+
+import scrapy
+from scrapy import Field
+from scrapy.loader.processors import MapCompose
+
+from GoodreadsScraper.items import UserProfileItem, UserReviewItem, safe_parse_date
+
+
+class ScrapyUserProfileItem(scrapy.Item):
+    profile_url = Field()
+
+
+class ScrapyUserReviewItem(scrapy.Item):
+    user_id = Field()
+    user_id_slug = Field()
+
+    book_link = Field()
+    book_name = Field()
+
+    author_link = Field()
+    author_name = Field()
+
+    date_read = Field(input_processor=MapCompose(safe_parse_date))
+    date_added = Field(input_processor=MapCompose(safe_parse_date))
+
+    user_rating = Field(serializer=int)
+
+
+def profile_values(count):
+    return [{"profile_url": f"https://www.goodreads.com/user/show/{i}-reader"} for i in range(count)]
+
+
+def review_values(count):
+    return [{
+        "user_id": str(i), "user_id_slug": f"{i}-reader",
+        "book_link": f"/book/show/{i}", "book_name": "A book",
+        "author_link": f"/author/show/{i}", "author_name": "An author",
+        "date_read": "2017-09-12 00:00:00", "date_added": "2017-09-12 00:00:00",
+        "user_rating": 5,
+    } for i in range(count)]
+
+
+CASES = [
+    ("user_profile", profile_values, ScrapyUserProfileItem, UserProfileItem),
+    ("user_review", review_values, ScrapyUserReviewItem, UserReviewItem),
+]
+
+
+def measure(item_cls, values):
+    """Bytes allocated per item while building and holding one item per dict of values"""
+    gc.collect()
+    tracemalloc.start()
+    items = [item_cls(item_values) for item_values in values]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return allocated / len(values)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Memory per item of the compact items against scrapy.Item')
+    parser.add_argument('--count', type=int, default=200000, help='Items built per case')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print(f"{'case':<14} {'item':<22} {'bytes/item':>10} {f'MB/{args.count}':>14}")
+    print("-" * 63)
+    for name, make_values, reference_cls, compact_cls in CASES:
+        values = make_values(args.count)
+        for item_cls in (reference_cls, compact_cls):
+            per_item = measure(item_cls, values)
+            print(f"{name:<14} {item_cls.__name__:<22} {per_item:>10.1f} {per_item * args.count / 2 ** 20:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
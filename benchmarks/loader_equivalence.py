@@ -0,0 +1,140 @@
+"""Check that the compiled extractors produce the same items as the ItemLoader code they replaced
+
+The loader based implementations of BookSpider.parse_legacy_book and UserReviewsSpider.build_review are kept here as
+the reference. Every fixture that one of them applies to is run through both, and any difference in the items
+is printed. The exit code is 1 if there was one.
+
+    python -m benchmarks.loader_equivalence
+"""
+import re
+import sys
+from urllib.parse import urlsplit
+
+from GoodreadsScraper.items import BookLoader, LegacyBookItem, UserReviewItem, UserReviewLoader
+from GoodreadsScraper.spiders.book_spider import BookSpider
+from GoodreadsScraper.spiders.user_reviews_spider import REVIEW_ROWS, REVIEW_ROW_EXTRACTOR, UserReviewsSpider
+from benchmarks.parser_benchmark import CASES
+
+SIMILAR_EDITIONS_ISBN_REGEX = re.compile(r"editionInfo\\'>\\nisbn:\s(\d+)\\n<\\")
+SIMILAR_EDITIONS_ISBN_13_REGEX = re.compile(r"editionInfo\\'>\\nisbn13:\s(\d+)\\n<\\")
+SIMILAR_EDITIONS_ASIN_REGEX = re.compile(r"editionInfo\\'>\\nasin:\s([A-Za-z0-9]+)\\n<\\")
+
+
+def loader_legacy_book(response):
+    loader = BookLoader(LegacyBookItem(), response=response)
+
+    loader.add_value('url', urlsplit(response.request.url).path)
+
+    loader.add_css("title", "#bookTitle::text")
+    loader.add_css("author", "a.authorName>span::text")
+    loader.add_css("author_url", 'a.authorName::attr(href)')
+
+    loader.add_css("num_ratings", "[itemprop=ratingCount]::attr(content)")
+    loader.add_css("num_reviews", "[itemprop=reviewCount]::attr(content)")
+    loader.add_css("avg_rating", "span[itemprop=ratingValue]::text")
+    loader.add_css("num_pages", "span[itemprop=numberOfPages]::text")
+
+    loader.add_css("language", "div[itemprop=inLanguage]::text")
+    loader.add_css('publish_date', 'div.row::text')
+    loader.add_css('publish_date', 'nobr.greyText::text')
+
+    loader.add_css("genres", 'div.left>a.bookPageGenreLink[href*="/genres/"]::text')
+    loader.add_css('series', 'div.infoBoxRowItem>a[href*="/series/"]::text')
+
+    loader.add_css('asin', 'div.infoBoxRowItem[itemprop=isbn]::text')
+    loader.add_css('asin', 'script::text', re=SIMILAR_EDITIONS_ASIN_REGEX)
+    loader.add_css('isbn', 'div.infoBoxRowItem[itemprop=isbn]::text')
+    loader.add_css('isbn', 'span[itemprop=isbn]::text')
+    loader.add_css('isbn', 'div.infoBoxRowItem::text')
+    loader.add_css('isbn', 'div.infoBoxRowItem::text')
+    loader.add_css('isbn', 'script::text', re=SIMILAR_EDITIONS_ISBN_REGEX)
+    loader.add_css('isbn13', 'div.infoBoxRowItem[itemprop=isbn]::text')
+    loader.add_css('isbn13', 'span[itemprop=isbn]::text')
+    loader.add_css('isbn13', 'div.infoBoxRowItem::text')
+    loader.add_css('isbn13', 'script::text', re=SIMILAR_EDITIONS_ISBN_13_REGEX)
+
+    loader.add_css('rating_histogram', 'script[type*="protovis"]::text')
+
+    return loader.load_item()
+
+
+def loader_reviews(response):
+    user_id = response.meta["user_id"]
+    for review_block in response.xpath('//tr[@class="bookalike review"]'):
+        goodreads_rating = review_block.xpath(
+            'td[@class="field rating"]//div[@class="value"]//span[@class=" staticStars notranslate"]/@title').get()
+        user_rating = UserReviewsSpider.convert_goodreads_ratings_to_star_count(goodreads_rating)
+
+        loader = UserReviewLoader(UserReviewItem(), review_block)
+        loader.add_value('user_id', user_id.split('-')[0])
+        loader.add_value('user_id_slug', user_id)
+
+        loader.add_xpath('book_link', 'td[@class="field title"]//a/@href')
+        loader.add_xpath('book_name', 'td[@class="field title"]//a/@title')
+
+        loader.add_xpath('author_link', 'td[@class="field author"]//a/@href')
+        loader.add_xpath('author_name', 'td[@class="field author"]//a/text()')
+
+        loader.add_xpath('date_read', 'td[@class="field date_read"]//div[@class="value"]//div//div//span/text()')
+        loader.add_xpath('date_added', 'td[@class="field date_added"]//div[@class="value"]//span/@title')
+
+        loader.add_value('user_rating', user_rating)
+        yield loader.load_item()
+
+
+def extractor_reviews(response):
+    # Every row, not only the rated ones parse() yields, so the rows without a rating are compared as well
+    user_id = response.meta["user_id"]
+    for review_row in REVIEW_ROWS(response.selector.root):
+        collected = REVIEW_ROW_EXTRACTOR.collect(review_row)
+        goodreads_rating = REVIEW_ROW_EXTRACTOR.first(collected, 'user_rating')
+        user_rating = UserReviewsSpider.convert_goodreads_ratings_to_star_count(goodreads_rating)
+        yield UserReviewsSpider.build_review(collected, user_id, user_rating)
+
+
+COMPARISONS = {
+    "book_show_legacy": (loader_legacy_book, lambda response: BookSpider().parse_legacy_book(response)),
+    "review_list": (lambda response: list(loader_reviews(response)),
+                    lambda response: list(extractor_reviews(response))),
+}
+
+
+def diff_items(expected, actual):
+    """Describe how two items differ, including the order of their fields, or return None if they don't"""
+    if type(expected) is not type(actual):
+        return f"expected a {type(expected).__name__}, got a {type(actual).__name__}"
+    if dict(expected) != dict(actual):
+        fields = sorted(set(expected) | set(actual))
+        return "; ".join(f"{field}: {expected.get(field)!r} != {actual.get(field)!r}"
+                         for field in fields if expected.get(field) != actual.get(field))
+    if list(expected) != list(actual):
+        return f"field order {list(expected)} != {list(actual)}"
+    return None
+
+
+def main():
+    failures = 0
+    for case in CASES:
+        if case.name not in COMPARISONS:
+            continue
+        reference, compiled = COMPARISONS[case.name]
+        expected, actual = reference(case.make_response()), compiled(case.make_response())
+        pairs = list(zip(expected, actual)) if isinstance(expected, list) else [(expected, actual)]
+        if isinstance(expected, list) and len(expected) != len(actual):
+            print(f"{case.name}: expected {len(expected)} items, got {len(actual)}")
+            failures += 1
+        for index, (expected_item, actual_item) in enumerate(pairs):
+            difference = diff_items(expected_item, actual_item)
+            if difference:
+                print(f"{case.name}[{index}]: {difference}")
+                failures += 1
+        print(f"{case.name}: compared {len(pairs)} items")
+
+    if failures:
+        print(f"{failures} differences")
+        sys.exit(1)
+    print("All items identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Offline benchmark of the spider parse callbacks against synthetic Goodreads pages
+
+Every case feeds a checked in fixture from benchmarks/fixtures to a spider callback, without touching the network, and
+reports how many pages and items per second the callback manages. Results can be saved as a baseline and later runs
+compared against it, so parse time regressions show up before they reach the crawl nodes.
+
+The fixtures are generated, not recorded: they follow the markup and __NEXT_DATA__ layout the spiders read, filled
+with made up text. They don't cover layout variants, nor the bulk of rendered markup around the __NEXT_DATA__ blob of
+real new style book pages, so absolute timings understate what DOM parsing costs on live pages.
+
+Baselines are machine specific, so save one on the machine you intend to compare on:
+
+    python -m benchmarks.parser_benchmark --save-baseline
+    python -m benchmarks.parser_benchmark --baseline benchmarks/baseline.json
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+from scrapy import Request
+from scrapy.http import HtmlResponse, Response, XmlResponse
+from scrapy.utils.spider import iterate_spider_output
+
+from GoodreadsScraper.spiders.author_spider import AuthorSpider
+from GoodreadsScraper.spiders.book_spider import BookSpider
+from GoodreadsScraper.spiders.user_id_network_spider import UserIdNetworkSpider
+from GoodreadsScraper.spiders.user_id_sitemap_spider import UserIdSitemapSpider
+from GoodreadsScraper.spiders.user_reviews_spider import UserReviewsSpider
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+class BenchmarkCase(object):
+    def __init__(self, name, callback_name, fixture, url, make_callback, response_cls=HtmlResponse, meta=None,
+                 gzipped=False):
+        self.name = name
+        self.callback_name = callback_name
+        self.fixture = fixture
+        self.url = url
+        self.make_callback = make_callback
+        self.response_cls = response_cls
+        self.meta = meta or {}
+        self.gzipped = gzipped
+        self._body = None
+
+    @property
+    def body(self):
+        if self._body is None:
+            with open(os.path.join(FIXTURES_DIR, self.fixture), "rb") as fixture_file:
+                body = fixture_file.read()
+            self._body = gzip.compress(body) if self.gzipped else body
+        return self._body
+
+    def make_response(self):
+        # Responses cache their selector, so every iteration gets a fresh one to include the DOM construction cost
+        request = Request(self.url, meta=dict(self.meta))
+        if self.response_cls is Response:
+            return Response(self.url, body=self.body, request=request)
+        return self.response_cls(self.url, body=self.body, encoding="utf-8", request=request)
+
+
+CASES = [
+    BenchmarkCase("book_show_new", "BookSpider.parse", "book_show_new.html",
+                  "https://www.goodreads.com/book/show/12232938-the-lovely-bones",
+                  # parse() is the real entry point and dispatches to extract_book for new style pages
+                  lambda: BookSpider().parse),
+    BenchmarkCase("book_show_legacy", "BookSpider.parse_legacy_book", "book_show_legacy.html",
+                  "https://www.goodreads.com/book/show/12232938-the-lovely-bones",
+                  lambda: BookSpider().parse_legacy_book),
+    BenchmarkCase("author_show", "AuthorSpider.parse_author", "author_show.html",
+                  "https://www.goodreads.com/author/show/2778055.Kurt_Vonnegut_Jr_",
+                  lambda: AuthorSpider().parse_author),
+    BenchmarkCase("review_list", "UserReviewsSpider.parse", "review_list.html",
+                  UserReviewsSpider.format_review_url("24697113-reb", 1),
+                  lambda: UserReviewsSpider(profiles="https://www.goodreads.com/user/show/24697113-reb").parse,
+                  meta={"user_id": "24697113-reb", "page": 1}),
+    BenchmarkCase("user_friends", "UserIdNetworkSpider.parse", "user_show_friends.html",
+                  "https://www.goodreads.com/user/show/24697113-david-fennessey",
+                  lambda: UserIdNetworkSpider().parse),
+    BenchmarkCase("sitemap_index", "UserIdSitemapSpider.parse", "siteindex.user.xml",
+                  "https://www.goodreads.com/siteindex.user.xml",
+                  lambda: UserIdSitemapSpider().parse, response_cls=XmlResponse),
+    BenchmarkCase("sitemap_shard", "UserIdSitemapSpider.parse", "sitemap.1.user.xml",
+                  "https://www.goodreads.com/sitemap.1.user.xml.gz",
+                  lambda: UserIdSitemapSpider().parse, response_cls=Response, gzipped=True),
+]
+
+
+def run_case(case, iterations, warmup):
+    timings = []
+    items = requests = 0
+    for iteration in range(warmup + iterations):
+        # Spiders keep per crawl state (e.g. the books already seen for a profile), so every iteration gets a new one
+        callback = case.make_callback()
+        response = case.make_response()
+        start = time.perf_counter()
+        output = list(iterate_spider_output(callback(response)))
+        elapsed = time.perf_counter() - start
+        if iteration >= warmup:
+            timings.append(elapsed)
+            requests = sum(1 for result in output if isinstance(result, Request))
+            items = sum(1 for result in output if result is not None and not isinstance(result, Request))
+
+    mean = statistics.mean(timings)
+    return {
+        "callback": case.callback_name,
+        "mean_ms": mean * 1000,
+        "median_ms": statistics.median(timings) * 1000,
+        "pages_per_sec": 1 / mean,
+        "items_per_page": items,
+        "items_per_sec": items / mean,
+        "requests_per_page": requests,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        baseline_mean = baseline[name]["mean_ms"]
+        change = (result["mean_ms"] - baseline_mean) / baseline_mean
+        result["baseline_mean_ms"] = baseline_mean
+        result["change"] = change
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def print_results(results):
+    header = f"{'case':<18} {'callback':<30} {'mean ms':>9} {'pages/s':>9} {'items/s':>10} {'vs base':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        change = f"{result['change']:+.1%}" if "change" in result else "n/a"
+        print(f"{name:<18} {result['callback']:<30} {result['mean_ms']:>9.3f} {result['pages_per_sec']:>9.1f} "
+              f"{result['items_per_sec']:>10.1f} {change:>8}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the spider parse callbacks')
+    parser.add_argument('--iterations', type=int, default=50, help='Timed iterations per case')
+    parser.add_argument('--warmup', type=int, default=5, help='Untimed iterations per case')
+    parser.add_argument('--case', action='append', help='Only run the named case, can be given multiple times')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline JSON file to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='Write the results to the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline before a case counts as a regression')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # The spiders log on every page, which would end up in the measurements
+    logging.basicConfig(level=logging.WARNING)
+
+    cases = [case for case in CASES if not args.case or case.name in args.case]
+    results = {case.name: run_case(case, args.iterations, args.warmup) for case in cases}
+
+    regressions = []
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.tolerance)
+
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+    elif regressions:
+        print(f"Regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Check that a Retry-After pause of one endpoint doesn't hold up the crawl of the others
+
+Crawls book and author pages from a fake download handler, with the project settings and a small CONCURRENT_REQUESTS.
+The first book request is answered with a 429 and a Retry-After, the rest with an empty page. Book pages must not be
+crawled before the pause is over, and author pages must all be crawled before it is, or the exit code is 1.
+
+    python -m benchmarks.retry_after_pause
+    python -m benchmarks.retry_after_pause --scheduler scrapy.core.scheduler.Scheduler
+"""
+import argparse
+import sys
+import time
+
+import scrapy
+from scrapy.crawler import CrawlerProcess
+from scrapy.http import HtmlResponse
+from scrapy.utils.project import get_project_settings
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+
+RESPONSE_SECS = 0.05
+
+
+class FakeDownloadHandler(object):
+    """Answers every request after RESPONSE_SECS, and the first book request with a 429"""
+    lazy = False
+    retry_after = None
+
+    def __init__(self, *args, **kwargs):
+        self.throttled = False
+
+    def download_request(self, request, spider):
+        if "/book/show/" in request.url and not self.throttled:
+            self.throttled = True
+            return deferLater(reactor, 0, HtmlResponse, request.url, status=429, request=request,
+                              headers={"Retry-After": str(self.retry_after)})
+        return deferLater(reactor, RESPONSE_SECS, HtmlResponse, request.url, body=b"<html></html>", request=request)
+
+
+class PauseSpider(scrapy.Spider):
+    name = "retry_after_pause"
+
+    def __init__(self, books, authors, **kwargs):
+        super().__init__(**kwargs)
+        self.books = books
+        self.authors = authors
+        self.crawled_at = {}
+
+    def start_requests(self):
+        # Books first, so that they are the ones waiting when the pause starts
+        for i in range(self.books):
+            yield scrapy.Request(f"https://www.goodreads.com/book/show/{i}")
+        for i in range(self.authors):
+            yield scrapy.Request(f"https://www.goodreads.com/author/show/{i}")
+
+    def parse(self, response):
+        self.crawled_at[response.url] = time.time()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check that a Retry-After pause only holds up its own endpoint')
+    parser.add_argument('--books', type=int, default=20, help='Book pages crawled, these get paused')
+    parser.add_argument('--authors', type=int, default=40, help='Author pages crawled alongside')
+    parser.add_argument('--retry-after', type=int, default=6, help='Retry-After of the 429, in seconds')
+    parser.add_argument('--scheduler', help='SCHEDULER to crawl with instead of the project one')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    FakeDownloadHandler.retry_after = args.retry_after
+    settings = get_project_settings()
+    settings.set('DOWNLOAD_HANDLERS', {'https': f'{__name__}.FakeDownloadHandler'})
+    settings.set('ROBOTSTXT_OBEY', False)
+    settings.set('HTTPCACHE_ENABLED', False)
+    settings.set('CONCURRENT_REQUESTS', 4)
+    settings.set('RANDOMIZE_DOWNLOAD_DELAY', False)
+    settings.set('ENDPOINT_THROTTLE_RATES', {'book': (50.0, 50.0), 'author': (20.0, 20.0)})
+    settings.set('LOG_LEVEL', 'WARNING')
+    if args.scheduler:
+        settings.set('SCHEDULER', args.scheduler)
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(PauseSpider)
+    started = time.time()
+    process.crawl(crawler, books=args.books, authors=args.authors)
+    process.start()
+
+    crawled_at = crawler.spider.crawled_at
+    books = sorted(at - started for url, at in crawled_at.items() if "/book/show/" in url)
+    authors = sorted(at - started for url, at in crawled_at.items() if "/author/show/" in url)
+    print(f"authors: {len(authors)} of {args.authors}, last after {authors[-1] if authors else 0:.1f}s")
+    print(f"books:   {len(books)} of {args.books}, first after {books[0] if books else 0:.1f}s")
+
+    failures = []
+    if len(books) != args.books or len(authors) != args.authors:
+        failures.append("not every page was crawled")
+    if books and books[0] < args.retry_after:
+        failures.append(f"books were crawled during the {args.retry_after}s pause")
+    if authors and authors[-1] >= args.retry_after:
+        failures.append(f"authors were held up by the {args.retry_after}s pause of books")
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,22 @@
 import argparse
 from collections import Counter
 
+import numpy as np
 import pandas as pd
 
+from GoodreadsScraper.dates import TIME_FORMAT, normalize_dates
+
+DEFAULT_CHUNKSIZE = 100000
+
+# Without explicit types every chunk infers its own, and a chunk with a missing value turns an integer column into
+# floats, so the same column would be written as 123 in some chunks and 123.0 in others
+COLUMN_DTYPES = {
+    'num_ratings': 'Int64',
+    'num_reviews': 'Int64',
+    'num_pages': 'Int64',
+    'avg_rating': 'float64',
+}
+
 
 def replace_missing_list_column_values(df, col_name):
     """Replace nans with empty list in list type columns
@@ -14,35 +28,126 @@ def replace_missing_list_column_values(df, col_name):
 
         Mutates the dataframe in place.
     """
-    missing_values = df[col_name].isnull()
-    df.loc[missing_values, col_name] = pd.Series(
-        [
-            [] for _ in range(missing_values.count())
-        ])
+    df[col_name] = [value if isinstance(value, list) else [] for value in df[col_name]]
+
+
+def top_genres(genre_counts, k=30):
+    """The k most common genres of a Counter, ties are broken by which genre was seen first"""
+    return [genre for genre, _ in genre_counts.most_common(k)]
 
 
-def one_hot_encode_genres(df, k=30):
+def count_genres(df, genre_counts=None):
+    """Count how many rows have each genre, adding to `genre_counts` if given"""
+    genre_counts = Counter() if genre_counts is None else genre_counts
+    # sort=False keeps the genres in the order they are first seen in, like counting row by row would
+    genre_counts.update(df['genres'].explode().dropna().value_counts(sort=False).to_dict())
+    return genre_counts
+
+
+def one_hot_encode_genres(df, k=30, genres=None):
     """One-hot encodes genres as columns, retaining the k most common genres.
 
+        Pass `genres` to encode a fixed set of genres instead, e.g. the most common ones of a whole file when
+        encoding it chunk by chunk. All genre columns are filled in a single pass over the exploded genre lists.
+
         Mutates the dataframe in place.
     """
-    genre_counts = Counter((genre for row_genres in df.genres for genre in row_genres))
+    if genres is None:
+        genres = top_genres(count_genres(df), k)
+
+    exploded = df['genres'].explode()
+    lengths = df['genres'].str.len().fillna(0).astype(int).clip(lower=1).to_numpy()
+    rows = np.repeat(np.arange(len(df)), lengths)
+    codes = pd.Categorical(exploded.to_numpy(), categories=genres).codes
+    matches = codes >= 0
 
-    for genre, genre_count in genre_counts.most_common(k):
-        df[genre] = df.genres.apply(lambda g: genre in g)
+    encoded = np.zeros((len(df), len(genres)), dtype=bool)
+    encoded[rows[matches], codes[matches]] = True
+    for position, genre in enumerate(genres):
+        df[genre] = encoded[:, position]
 
 
 def breakdown_publish_date(df):
     """Adds publish_year, publish_month and publish_day as individual columns"""
+    # Normalizing first means a single exact format is left for pandas to parse, instead of inferring one
     publish_dates = pd.to_datetime(
-        df['publish_date'],
-        format="%Y-%m-%d %H:%M:%S",
-        infer_datetime_format=True,
+        pd.Series(normalize_dates(df['publish_date']), index=df.index),
+        format=TIME_FORMAT,
         errors='coerce')
 
-    df['publish_year'] = publish_dates.apply(lambda k: k.year)
-    df['publish_month'] = publish_dates.apply(lambda k: k.month)
-    df['publish_day'] = publish_dates.apply(lambda k: k.day)
+    df['publish_year'] = publish_dates.dt.year.astype('Int64')
+    df['publish_month'] = publish_dates.dt.month.astype('Int64')
+    df['publish_day'] = publish_dates.dt.day.astype('Int64')
+
+
+class UrlDeduplicator(object):
+    """Drops rows whose url was already seen, in this chunk or any earlier one
+
+    Only a 64 bit hash of every url is kept, which is what bounds the memory of a streaming cleanup by the number of
+    distinct books rather than the size of the files.
+    """
+
+    def __init__(self):
+        self.seen = set()
+
+    def __call__(self, df):
+        hashes = pd.util.hash_pandas_object(df['url'], index=False).to_numpy()
+        first = ~pd.Series(hashes).duplicated().to_numpy()
+        seen = self.seen
+        first &= np.fromiter((h not in seen for h in hashes.tolist()), dtype=bool, count=len(hashes))
+        seen.update(hashes[first].tolist())
+        return df[first]
+
+
+def iter_chunks(filenames, chunksize=DEFAULT_CHUNKSIZE):
+    """Stream the rows of JSONLINES files as DataFrames of at most `chunksize` rows"""
+    for filename in filenames:
+        with pd.read_json(filename, lines=True, chunksize=chunksize, dtype=COLUMN_DTYPES) as reader:
+            yield from reader
+
+
+def clean_chunk(df, genres, columns):
+    """Apply the script mode cleanup to a single chunk, with the genres and input columns of all chunks"""
+    df = df.reindex(columns=columns)
+    for col_name in ('genres', 'awards'):
+        if col_name in df:
+            replace_missing_list_column_values(df, col_name)
+
+    one_hot_encode_genres(df, genres=genres)
+    breakdown_publish_date(df)
+
+    if 'awards' in df:
+        df['num_awards'] = df['awards'].str.len()
+    return df
+
+
+def clean_files(filenames, output, chunksize=DEFAULT_CHUNKSIZE, k=30):
+    """Clean JSONLINES files into a single CSV file, holding at most one chunk of rows in memory
+
+    The first pass over the files collects the columns and genre counts, the second one cleans and writes every chunk.
+    """
+    dedupe = UrlDeduplicator()
+    genre_counts = Counter()
+    columns = {}
+    for chunk in iter_chunks(filenames, chunksize):
+        chunk = dedupe(chunk)
+        columns.update(dict.fromkeys(chunk.columns))
+        if 'genres' in chunk:
+            count_genres(chunk, genre_counts)
+    genres = top_genres(genre_counts, k)
+
+    dedupe = UrlDeduplicator()
+    header = True
+    for chunk in iter_chunks(filenames, chunksize):
+        chunk = dedupe(chunk)
+        # Files that overlap, like concatenated re-scrapes, leave chunks without a single new url
+        if chunk.empty:
+            continue
+        chunk = clean_chunk(chunk, genres, list(columns))
+        if header:
+            print(chunk.head())
+        chunk.to_csv(output, index=False, header=header, mode='w' if header else 'a')
+        header = False
 
 ###################################
 ######### For script mode #########
@@ -52,26 +157,12 @@ def parse_args():
     parser = argparse.ArgumentParser(description='Aggregator script to clean and transform Goodreads data')
     parser.add_argument('-f', '--filenames', nargs='+', help='Space separated JSONLINES files extracted from Goodreads', required=True)
     parser.add_argument('-o', '--output', help='Output CSV file name to which data will be extracted', required=True)
+    parser.add_argument('-c', '--chunksize', type=int, default=DEFAULT_CHUNKSIZE, help='Rows read and cleaned at a time')
     return parser.parse_args()
 
 def main():
     args = parse_args()
-
-    dfs = [pd.read_json(filename, lines=True) for filename in args.filenames]
-    df = pd.concat(dfs)
-    df = df.drop_duplicates(subset=['url'])
-
-    replace_missing_list_column_values(df, 'genres')
-    replace_missing_list_column_values(df, 'awards')
-
-    one_hot_encode_genres(df)
-    breakdown_publish_date(df)
-
-    df['num_awards'] = df['awards'].apply(len)
-
-    print(df.head())
-
-    df.to_csv(args.output, index=False)
+    clean_files(args.filenames, args.output, args.chunksize)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,101 @@
-from google.cloud import bigquery
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# BigQuery caps a streaming insert request at 10MB and recommends ~500 rows per request
+DEFAULT_MAX_CHUNK_BYTES = 5 * 1024 * 1024
+DEFAULT_MAX_CHUNK_ROWS = 500
+
+# Rows rejected for these reasons will fail the same way every time, anything else (e.g. "stopped" for the valid rows
+# of a request that contained an invalid one, or "backendError") is worth another attempt
+NON_RETRYABLE_REASONS = {"invalid", "invalidQuery", "notFound"}
+
 
 class BigQueryDao(object):
-    def __init__(self, logger):
-        self.client = bigquery.Client()
+    """Streams rows into BigQuery in size bounded chunks, inserting several chunks at once
+
+    `client` only needs an `insert_rows_json(table_name, rows)` method that returns a list of
+    `{"index": ..., "errors": [{"reason": ..., "message": ...}]}` mappings for the rows it rejected, like
+    `google.cloud.bigquery.Client` does. `dao.fakes.InMemoryBigQueryClient` implements it for offline use.
+    """
+
+    def __init__(self, logger, client=None, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                 max_chunk_rows=DEFAULT_MAX_CHUNK_ROWS, max_workers=4, max_retries=3, retry_backoff_secs=1.0):
+        if client is None:
+            from google.cloud import bigquery
+            client = bigquery.Client()
+        self.client = client
         self.logger = logger
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_chunk_rows = max_chunk_rows
+        self.max_retries = max_retries
+        self.retry_backoff_secs = retry_backoff_secs
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bigquery-writer")
 
     def write(self, rows_to_insert, table_name):
-        errors = self.client.insert_rows_json(table_name, [dto.dict() for dto in rows_to_insert])
+        """Insert the rows and return the errors of the rows that could not be written
+
+        Rows can be row dicts or DTOs, error indexes refer to positions in `rows_to_insert`.
+        """
+        rows = [row if isinstance(row, dict) else row.dict() for row in rows_to_insert]
+        chunks = list(self._chunk(rows))
+        futures = [self.executor.submit(self._write_chunk, table_name, chunk_number, offset, chunk)
+                   for chunk_number, (offset, chunk) in enumerate(chunks)]
+        errors = []
+        for future in futures:
+            errors.extend(future.result())
+
         if not errors:
-            self.logger.info(f"Successfully wrote {len(rows_to_insert)} rows to {table_name}!")
+            self.logger.info(f"Successfully wrote {len(rows)} rows to {table_name} in {len(chunks)} chunks!")
         else:
-            self.logger.warning(f"Encountered errors while inserting rows: {errors}")
+            self.logger.warning(f"Failed to write {len(errors)} of {len(rows)} rows to {table_name}: {errors}")
+        return errors
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _chunk(self, rows):
+        """Yield (offset, rows) chunks that stay below both the row count and the payload size limits"""
+        chunk, chunk_bytes, offset = [], 0, 0
+        for index, row in enumerate(rows):
+            # +1 for the comma separating the rows in the request body
+            row_bytes = len(json.dumps(row, default=str).encode("utf-8")) + 1
+            if chunk and (len(chunk) >= self.max_chunk_rows or chunk_bytes + row_bytes > self.max_chunk_bytes):
+                yield offset, chunk
+                chunk, chunk_bytes, offset = [], 0, index
+            chunk.append(row)
+            chunk_bytes += row_bytes
+        if chunk:
+            yield offset, chunk
+
+    def _write_chunk(self, table_name, chunk_number, offset, chunk):
+        # Maps the index of each row still to be sent to its index within the chunk
+        pending = list(range(len(chunk)))
+        failed = []
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.retry_backoff_secs * 2 ** (attempt - 1))
+
+            started = time.monotonic()
+            try:
+                errors = self.client.insert_rows_json(table_name, [chunk[index] for index in pending])
+            except Exception as e:
+                # Transport level failures reject the whole request, so every pending row is retried
+                errors = [{"index": index, "errors": [{"reason": "exception", "message": str(e)}]}
+                          for index in range(len(pending))]
+            latency_ms = (time.monotonic() - started) * 1000
+            self.logger.info(f"Chunk {chunk_number} attempt {attempt + 1}: {len(pending)} rows to {table_name} "
+                             f"in {latency_ms:.0f}ms, {len(errors)} rejected")
+
+            retry = []
+            for error in errors:
+                row_index = pending[error["index"]]
+                reasons = {e.get("reason") for e in error.get("errors", [])}
+                if reasons & NON_RETRYABLE_REASONS or attempt == self.max_retries:
+                    failed.append({"index": offset + row_index, "errors": error.get("errors", [])})
+                else:
+                    retry.append(row_index)
+            if not retry:
+                break
+            pending = retry
+        return failed
@@ -0,0 +1,50 @@
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+PROJECT = "book-suggestion-please"
+LOCATION = "us-east1"
+
+
+class CloudTasksDao(object):
+    """Creates Cloud Tasks that POST a JSON payload to one of the scraper endpoints
+
+    `client` only needs the `queue_path` and `create_task` methods of `google.cloud.tasks_v2.CloudTasksClient`,
+    `dao.fakes.InMemoryCloudTasksClient` implements them for offline use. `create_task` blocks for the whole RPC
+    (and its retries), so callers on the Twisted reactor thread must run it in a thread pool.
+    """
+
+    def __init__(self, queue_name, http_target, client=None, project=PROJECT, location=LOCATION, max_retries=3,
+                 retry_backoff_secs=1.0):
+        if client is None:
+            from google.cloud import tasks_v2
+            client = tasks_v2.CloudTasksClient()
+        self.client = client
+        self.parent = self.client.queue_path(project, location, queue_name)
+        self.http_target = http_target
+        self.max_retries = max_retries
+        self.retry_backoff_secs = retry_backoff_secs
+
+    def create_task(self, payload):
+        """Create a task with the given JSON payload and return its name"""
+        task = {
+            "http_request": {
+                "http_method": "POST",
+                "url": self.http_target,
+                "headers": {"Content-type": "application/json"},
+                # The API expects a payload of type bytes
+                "body": json.dumps(payload).encode(),
+            }
+        }
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.client.create_task(request={"parent": self.parent, "task": task})
+                return response.name
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                backoff = self.retry_backoff_secs * 2 ** attempt
+                logger.warning(f"Failed to create task on attempt {attempt + 1}, retrying in {backoff}s: {e}")
+                time.sleep(backoff)
@@ -0,0 +1,74 @@
+"""In-memory stand-ins for the GCP clients used by the DAOs, for running them offline"""
+import threading
+from collections import defaultdict
+
+
+class InMemoryBigQueryClient(object):
+    """Records inserted rows per table instead of sending them to BigQuery
+
+    `fail_rows` maps a row predicate to the error reason the row should be rejected with. Each predicate rejects a
+    row `times` times before letting it through, so retries can be exercised as well.
+    """
+
+    def __init__(self, fail_rows=None, times=1):
+        self.tables = defaultdict(list)
+        self.requests = []
+        self.fail_rows = fail_rows or {}
+        self._remaining_failures = defaultdict(lambda: times)
+        self._lock = threading.Lock()
+
+    def insert_rows_json(self, table_name, rows):
+        with self._lock:
+            self.requests.append((table_name, len(rows)))
+            errors = []
+            for index, row in enumerate(rows):
+                reason = self._failure_reason(row)
+                if reason is not None:
+                    errors.append({"index": index, "errors": [{"reason": reason, "message": f"fake {reason}"}]})
+            if any(e["errors"][0]["reason"] == "invalid" for e in errors):
+                # Like BigQuery, one invalid row makes the whole request fail, the other rows are reported as stopped
+                rejected = {e["index"] for e in errors}
+                errors.extend({"index": index, "errors": [{"reason": "stopped", "message": ""}]}
+                              for index in range(len(rows)) if index not in rejected)
+            else:
+                self.tables[table_name].extend(row for index, row in enumerate(rows)
+                                               if index not in {e["index"] for e in errors})
+            return sorted(errors, key=lambda e: e["index"])
+
+    def _failure_reason(self, row):
+        for predicate, reason in self.fail_rows.items():
+            key = (id(predicate), repr(sorted(row.items())))
+            if predicate(row) and (reason == "invalid" or self._remaining_failures[key] > 0):
+                self._remaining_failures[key] -= 1
+                return reason
+        return None
+
+
+class InMemoryCloudTasksClient(object):
+    """Records created tasks per queue instead of sending them to Cloud Tasks
+
+    The first `fail_first` calls to `create_task` raise, to exercise retries.
+    """
+
+    def __init__(self, fail_first=0):
+        self.tasks = defaultdict(list)
+        self.fail_first = fail_first
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def queue_path(project, location, queue):
+        return f"projects/{project}/locations/{location}/queues/{queue}"
+
+    def create_task(self, request):
+        with self._lock:
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                raise ConnectionError("fake transient failure")
+            tasks = self.tasks[request["parent"]]
+            tasks.append(request["task"])
+            return _CreatedTask(f"{request['parent']}/tasks/{len(tasks)}")
+
+
+class _CreatedTask(object):
+    def __init__(self, name):
+        self.name = name
@@ -0,0 +1,50 @@
+import sqlite3
+from time import time
+
+
+class RecrawlStateDao(object):
+    """Local store of when each book was last scraped and how many ratings/reviews it had at the time
+
+    The previous observation is kept around as well, which is what lets us estimate how fast a book is changing.
+    """
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path, timeout=30)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS books (
+                url TEXT PRIMARY KEY,
+                last_scraped REAL NOT NULL,
+                num_ratings INTEGER,
+                num_reviews INTEGER,
+                prev_scraped REAL,
+                prev_num_ratings INTEGER,
+                prev_num_reviews INTEGER
+            )""")
+
+    def record(self, url, num_ratings, num_reviews, scraped_at=None):
+        self.db.execute("""
+            INSERT INTO books (url, last_scraped, num_ratings, num_reviews) VALUES (?, ?, ?, ?)
+            ON CONFLICT(url) DO UPDATE SET
+                prev_scraped = last_scraped,
+                prev_num_ratings = num_ratings,
+                prev_num_reviews = num_reviews,
+                last_scraped = excluded.last_scraped,
+                num_ratings = excluded.num_ratings,
+                num_reviews = excluded.num_reviews
+            WHERE excluded.last_scraped > last_scraped""",
+                        (url, scraped_at if scraped_at is not None else time(), num_ratings, num_reviews))
+
+    def iter_books(self):
+        cursor = self.db.execute("""
+            SELECT url, last_scraped, num_ratings, num_reviews, prev_scraped, prev_num_ratings, prev_num_reviews
+            FROM books""")
+        columns = [description[0] for description in cursor.description]
+        for row in cursor:
+            yield dict(zip(columns, row))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
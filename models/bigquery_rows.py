@@ -0,0 +1,93 @@
+"""Batch conversion of scraped items into BigQuery rows
+
+Building a pydantic DTO per item only to call .dict() on it again costs more than the rest of the write path. Instead,
+the columns of a DTO, and a coercion function per column, are compiled once, and items are converted to the same row
+dicts the DTO would produce with a plain loop over those columns. A row that can't be converted is reported and
+skipped without affecting the rest of the batch.
+"""
+from datetime import datetime
+
+from models.books_bigquery_dto import BooksBigQueryDto, GenreList
+from models.user_review_bigquery_dto import UserReviewBigQueryDto
+
+INGEST_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def to_str(value):
+    # Like pydantic, numbers are converted but anything else has to be a string already
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        return str(value)
+    raise TypeError(f"str type expected, got {type(value).__name__}")
+
+
+def to_int(value):
+    return value if type(value) is int else int(value)
+
+
+def to_float(value):
+    return value if type(value) is float else float(value)
+
+
+def to_genre_list(value):
+    return {"list": [{"element": to_str(genre)} for genre in value]}
+
+
+COERCERS = {
+    str: to_str,
+    int: to_int,
+    float: to_float,
+    GenreList: to_genre_list,
+}
+
+
+class RowConverter(object):
+    """Converts item dicts into the rows `dto_cls(**item).dict()` would return
+
+    Values are looked up by field alias first and by field name second. `ingest_time` is set to the time the batch is
+    converted rather than to the DTO's default.
+    """
+
+    def __init__(self, dto_cls):
+        self.columns = []
+        for field in dto_cls.__fields__.values():
+            keys = tuple(dict.fromkeys((field.alias, field.name)))
+            coerce = None if field.name == "ingest_time" else COERCERS[field.outer_type_]
+            self.columns.append((field.name, keys, coerce, field.required))
+
+    def convert(self, items):
+        """Return the rows of the items that could be converted, and a list of (index, error) for the others"""
+        ingest_time = datetime.today().strftime(INGEST_TIME_FORMAT)
+        rows, errors = [], []
+        for index, item in enumerate(items):
+            try:
+                rows.append(self._convert_item(item, ingest_time))
+            except (TypeError, ValueError) as e:
+                errors.append((index, str(e)))
+        return rows, errors
+
+    def _convert_item(self, item, ingest_time):
+        row = {}
+        for name, keys, coerce, required in self.columns:
+            if coerce is None:
+                row[name] = ingest_time
+                continue
+            value = None
+            for key in keys:
+                if key in item:
+                    value = item[key]
+                    break
+            if value is not None:
+                try:
+                    value = coerce(value)
+                except (TypeError, ValueError) as e:
+                    raise ValueError(f"{name}: {e}") from e
+            elif required:
+                raise ValueError(f"{name}: field required")
+            row[name] = value
+        return row
+
+
+BOOK_ROWS = RowConverter(BooksBigQueryDto)
+USER_REVIEW_ROWS = RowConverter(UserReviewBigQueryDto)
@@ -6,3 +6,4 @@ from pydantic import BaseModel
 class BookScrapeRequest(BaseModel):
     book_urls: List[str]
     persist: bool = True
+    stream: bool = False
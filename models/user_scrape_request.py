@@ -6,3 +6,4 @@ from pydantic import BaseModel
 class UserScrapeRequest(BaseModel):
     profiles: List[str]
     persist: bool = True
+    stream: bool = False
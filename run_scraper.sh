@@ -24,6 +24,7 @@ fi
 
 scrapy crawl \
 	--logfile=scrapy.log \
+	--set HTTPCACHE_ENABLED=True \
 	--set OUTPUT_FILE_SUFFIX="$JSONLINE_FILE_PREFIX"_"$START_PAGE"_"$END_PAGE" \
 	-a start_page_no=$START_PAGE \
 	-a end_page_no=$END_PAGE \
@@ -1,23 +1,126 @@
 import json
 import logging
-import os
-import subprocess
-import uuid
-from typing import List
 
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify
 from flask_pydantic import validate
-from pydantic import parse_obj_as, ValidationError
 
+from GoodreadsScraper.crawl_engine import CrawlEngine
+from GoodreadsScraper.httpcache import page_cache_key
+from GoodreadsScraper.jobs import JobManager, JobQueueFull
+from GoodreadsScraper.result_cache import CoalescingCache
+from GoodreadsScraper.spiders.book_spider import BookSpider
+from GoodreadsScraper.spiders.user_reviews_spider import UserReviewsSpider
 from dao.big_query_dao import BigQueryDao
+from models.bigquery_rows import BOOK_ROWS, USER_REVIEW_ROWS
 from models.book_scrape_request import BookScrapeRequest
-from models.books_bigquery_dto import BooksBigQueryDto, BOOKS_TABLE
-from models.user_review_bigquery_dto import UserReviewBigQueryDto, USER_REVIEWS_TABLE
+from models.books_bigquery_dto import BOOKS_TABLE
+from models.user_review_bigquery_dto import USER_REVIEWS_TABLE
 from models.user_scrape_request import UserScrapeRequest
 
 app = Flask(__name__)
 app.logger.setLevel(logging.INFO)
 bq = BigQueryDao(app.logger)
+crawl_engine = CrawlEngine()
+jobs = JobManager.from_settings(crawl_engine.settings)
+results_cache = CoalescingCache.from_settings(crawl_engine.settings)
+
+
+def stream_ndjson(items):
+    # Once the first line is out the status code can't change anymore, so all we can do on failure is stop early
+    try:
+        for item in items:
+            yield json.dumps(item) + "\n"
+    except Exception as e:
+        app.logger.info(f"Encountered exception while streaming: {e}")
+
+
+def book_cache_key(book_url):
+    return page_cache_key(BookSpider._format_book_url(book_url)) or ("book", book_url)
+
+
+def profile_cache_key(profile_url):
+    user_id = UserReviewsSpider.extract_username_from_url(profile_url)
+    return ("user", user_id.split("-")[0]) if user_id else ("user", profile_url)
+
+
+def cached_scrape(urls_by_key, crawl, item_key):
+    """Return the scraped items per key, along with the items that couldn't be matched to any key
+
+    Only the keys that aren't cached, or being scraped by another request already, are passed on to crawl(urls). Keys
+    nothing was scraped for are left out and not cached, neither are the unmatched items (e.g. of redirected books).
+    """
+    unmatched = []
+
+    def fetch(keys):
+        items_by_key = {}
+        for item in crawl([urls_by_key[key] for key in keys]):
+            key = item_key(item)
+            if key in keys:
+                items_by_key.setdefault(key, []).append(item)
+            else:
+                unmatched.append(item)
+        return items_by_key
+
+    cached = results_cache.get_many(urls_by_key, fetch)
+    return {key: cached[key] for key in urls_by_key if cached.get(key)}, unmatched
+
+
+def persist_once(items_by_key, unmatched, write):
+    """Persist the scraped items with write(items), skipping the cached ones an earlier request persisted already"""
+    keys = results_cache.claim(items_by_key, "persisted")
+    items = [item for key in keys for item in items_by_key[key]] + unmatched
+    if not items:
+        return
+    try:
+        errors = write(items)
+    except Exception:
+        results_cache.invalidate(keys)
+        raise
+    if errors:
+        # Let the next delivery of the batch write them again
+        results_cache.invalidate(keys)
+
+
+def convert_rows(converter, result_json_list):
+    # Books are super fussy and are missing a lot of data, but we don't want to spoil the entire payload
+    # so we will just dump the items we can't convert
+    rows, errors = converter.convert(result_json_list)
+    for index, error in errors:
+        app.logger.info(f"Could not convert {result_json_list[index]} into a row. Exception: {error}")
+    return rows
+
+
+def run_user_scrape(body: UserScrapeRequest):
+    """Scrape the reviews of the requested profiles, returning them unless they are persisted to BigQuery"""
+    items_by_key, unmatched = cached_scrape(
+        {profile_cache_key(profile): profile for profile in body.profiles},
+        lambda profiles: crawl_engine.crawl(UserReviewsSpider, profiles=",".join(profiles)),
+        lambda review: ("user", review["user_id"]))
+    if not body.persist:
+        return [review for reviews in items_by_key.values() for review in reviews] + unmatched
+    persist_once(items_by_key, unmatched, write_user_reviews)
+    return None
+
+
+def write_user_reviews(result_json_list):
+    return bq.write(convert_rows(USER_REVIEW_ROWS, result_json_list), USER_REVIEWS_TABLE)
+
+
+def run_book_scrape(body: BookScrapeRequest):
+    """Scrape the requested books, returning them unless they are persisted to BigQuery"""
+    items_by_key, unmatched = cached_scrape(
+        {book_cache_key(book_url): book_url for book_url in body.book_urls},
+        lambda book_urls: crawl_engine.crawl(BookSpider, books=",".join(book_urls)),
+        lambda book: book_cache_key(book["url"]))
+    if not body.persist:
+        return [book for books in items_by_key.values() for book in books] + unmatched
+    persist_once(items_by_key, unmatched, write_books)
+    return None
+
+
+def write_books(result_json_list):
+    return bq.write(convert_rows(BOOK_ROWS, result_json_list), BOOKS_TABLE)
+
 
 @app.route('/scrape-users', methods=['POST'])
 @validate()
@@ -25,26 +128,21 @@ def scrape_user_profiles(body: UserScrapeRequest):
     comma_delimited_profiles = ",".join(body.profiles)
     app.logger.info(f"Processing user batch: {body.profiles}")
 
-    # Be super careful here. I am using GCP Cloud Run to limit concurrency to 1 per node. If you don't have an external
-    # mechanism, you will potentially start a ton of scrapers which will compete for resources and also not respect your
-    # desired requests per second. If you wanted to purely solve this in python, ou could use semaphores or uwsgi
-    # to limit concurrency
-    output_file = f"{uuid.uuid4()}.json"
+    # The crawl engine runs at most CRAWL_ENGINE_MAX_CRAWLS crawls at once, further requests wait for a free slot while
+    # holding on to their HTTP connection. Use the /jobs endpoints to queue a batch without waiting for it instead.
+    # Streamed items go straight to the client, so streaming requests don't use (or fill) the results cache
+    if body.stream and not body.persist:
+        items = crawl_engine.iter_crawl(UserReviewsSpider, profiles=comma_delimited_profiles)
+        return Response(stream_ndjson(items), mimetype="application/x-ndjson")
+
     response = dict()
     try:
-        subprocess.check_output(
-            ['scrapy', 'crawl', "user_reviews", "-o", output_file, "-a", f"profiles={comma_delimited_profiles}"])
-        with open(output_file) as results:
-            result_json_list = json.load(results)
-            if not body.persist:
-                response["response"] = result_json_list
-            else:
-                user_review_list = parse_obj_as(List[UserReviewBigQueryDto], result_json_list)
-                bq.write(user_review_list, USER_REVIEWS_TABLE)
+        result = run_user_scrape(body)
+        if result is not None:
+            response["response"] = result
     except Exception as e:
         app.logger.info(f"Encountered exception: {e}")
     finally:
-        os.remove(output_file)
         return jsonify(response)
 
 
@@ -54,32 +152,68 @@ def scrape_books(body: BookScrapeRequest):
     comma_delimited_profiles = ",".join(body.book_urls)
     app.logger.info(f"Processing book batch: {body.book_urls}")
 
-    output_file = f"{uuid.uuid4()}.json"
+    if body.stream and not body.persist:
+        items = crawl_engine.iter_crawl(BookSpider, books=comma_delimited_profiles)
+        return Response(stream_ndjson(items), mimetype="application/x-ndjson")
+
     response = dict()
     try:
-        subprocess.check_output(
-            ['scrapy', 'crawl', "book", "-o", output_file, "-a", f"books={comma_delimited_profiles}"])
-        with open(output_file) as results:
-            result_json_list = json.load(results)
-            if not body.persist:
-                response["response"] = result_json_list
-            else:
-                # Books are super fussy and are missing a lot of data, but we don't want to spoil the entire payload
-                # so we will just dump books we can't parse
-                book_list = []
-                try:
-                    for book in result_json_list:
-                        book_list.append(parse_obj_as(BooksBigQueryDto, book))
-                except ValidationError as error:
-                    app.logger.info(f"Could not parse {book} into DTO. Exception: {error}")
-                bq.write(book_list, BOOKS_TABLE)
+        result = run_book_scrape(body)
+        if result is not None:
+            response["response"] = result
     except Exception as e:
         app.logger.info(f"Encountered exception: {e}")
     finally:
-        os.remove(output_file)
         return jsonify(response)
 
 
+def submit_job(kind, function, body):
+    try:
+        job = jobs.submit(kind, function, body)
+    except JobQueueFull as e:
+        return jsonify({"error": str(e)}), 429
+    app.logger.info(f"Queued {kind} job {job.id}")
+    return jsonify(job.to_dict()), 202, {"Location": f"/jobs/{job.id}"}
+
+
+@app.route('/jobs/scrape-users', methods=['POST'])
+@validate()
+def submit_user_scrape_job(body: UserScrapeRequest):
+    return submit_job("scrape-users", run_user_scrape, body)
+
+
+@app.route('/jobs/scrape-books', methods=['POST'])
+@validate()
+def submit_book_scrape_job(body: BookScrapeRequest):
+    return submit_job("scrape-books", run_book_scrape, body)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>/results', methods=['GET'])
+def job_results(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
+    if not job.finished:
+        return jsonify(job.to_dict()), 409
+    response = job.to_dict()
+    if job.result is not None:
+        response["response"] = job.result
+    return jsonify(response)
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(results_cache.stats())
+
+
 @app.route('/', methods=['GET'])
 def hello_world():
     return jsonify({"hello": "world"})